@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class BatchLedger:
+    """A SQLite ledger of the units of work of a batch run, so that a rerun can skip what is already done.
+
+    A unit is one output (variant) for one brain of one nucleus with one filter area. It is keyed by those
+    together with a hash of the input image and the parameters it was made with, so changing either the image
+    or the parameters makes the unit pending again. Failed units are recorded with their traceback.
+
+    Attributes
+    ----------
+    path : str
+        The SQLite file the ledger is kept in
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS units ('
+                                    'nucleus TEXT, brain TEXT, filter_area TEXT, variant TEXT, '
+                                    'input_hash TEXT, params TEXT, status TEXT, traceback TEXT, updated REAL, '
+                                    'PRIMARY KEY (nucleus, brain, filter_area, variant, input_hash, params))')
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared across a fork or between threads (e.g. ImagePrefetcher's), so each
+        # thread of each process opens its own
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = sqlite3.connect(self.path, timeout=60)
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @staticmethod
+    def file_hash(fname: str) -> str:
+        """Returns the SHA-256 hex digest of a file's contents."""
+        digest = hashlib.sha256()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def params_key(params: dict) -> str:
+        """Returns a canonical string for a dictionary of parameters."""
+        return json.dumps(params, sort_keys=True)
+
+    def is_done(self, nucleus: str, brain: str, filter_area: str, variant: str, input_hash: str,
+                params: str) -> bool:
+        """Whether the unit has been recorded as done."""
+        row = self.connection.execute('SELECT status FROM units WHERE nucleus = ? AND brain = ? AND filter_area = ? '
+                                      'AND variant = ? AND input_hash = ? AND params = ?',
+                                      (nucleus, brain, filter_area, variant, input_hash, params)).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def mark_done(self, nucleus: str, brain: str, filter_area: str, variant: str, input_hash: str,
+                  params: str) -> None:
+        """Records the unit as done."""
+        self._record(nucleus, brain, filter_area, variant, input_hash, params, 'done', None)
+
+    def mark_failed(self, nucleus: str, brain: str, filter_area: str, variant: str, input_hash: str,
+                    params: str, traceback: str) -> None:
+        """Records the unit as failed, along with the traceback of the failure."""
+        self._record(nucleus, brain, filter_area, variant, input_hash, params, 'failed', traceback)
+
+    def failures(self) -> list:
+        """Returns the (nucleus, brain, filter_area, variant, traceback) of every failed unit."""
+        return self.connection.execute('SELECT nucleus, brain, filter_area, variant, traceback FROM units '
+                                       'WHERE status = ?', ('failed',)).fetchall()
+
+    def _record(self, nucleus: str, brain: str, filter_area: str, variant: str, input_hash: str, params: str,
+                status: str, traceback: str) -> None:
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (nucleus, brain, filter_area, variant, input_hash, params, status, traceback,
+                                     time.time()))
@@ -1,43 +1,207 @@
 from ProjPredictor import ProjPredictor
+from BatchLedger import BatchLedger
+from ImagePrefetcher import ImagePrefetcher
+from Instrumentation import Instrumentation
+from ResultCache import ResultCache
+import argparse
+import itertools
+import multiprocessing
 import os
 import pandas as pd
+import time
+import traceback
+from typing import Callable, List, Tuple, Union
+import numpy as np
+from threadpoolctl import threadpool_limits
 from tqdm import tqdm
 
 image_path = '/transformix_output_ilastik/result_fixed.tif'
-areas = pd.read_csv('annotation_info_0118_1327.csv')
-areas = areas[areas['consider'] == 1]['name'].values.tolist()
-
 nuclei = [('DN', 'Dentate nucleus'), ('FN', 'Fastigial nucleus'), ('IN', 'Interposed nucleus')]
-pp = ProjPredictor(verbose=False)
-# area_filter = 'Ventral medial nucleus of the thalamus'
-area_filter = 'Thalamus'
-for nucleus in nuclei:
-    d = f'datafornomi/{nucleus[0]}fornomi/'
-    brains = os.listdir(d)
-    brains = [brain for brain in brains if not brain.startswith('.')]
-    for brain in tqdm(brains):
-        pp.set_image_from_file(d + brain + image_path, source_area=nucleus[1], reshape=True)
-        pp.threshold(0.2)
-        pp.filter_by_name(area_filter)
-        pp.vol_to_probs()
-        pp.save_projections(f'raw_proj/{nucleus[0]}{brain[-3:]}_filter-{area_filter}_raw_proj.tiff')
-        pp.save_proj_by_area(structure_name=areas,
-                             normalize_source=True,
-                             normalize_target=True,
-                             fname=f'proj_by_area_justus/{nucleus[0]}{brain[-3:]}_filter-{area_filter}'
-                                   f'_both-norm_proj_by_area.pickle')
-        pp.save_proj_by_area(structure_name=areas,
-                             normalize_source=False,
-                             normalize_target=True,
-                             fname=f'proj_by_area_justus/{nucleus[0]}{brain[-3:]}_filter-{area_filter}'
-                                   f'_target-norm_proj_by_area.pickle')
-        pp.save_proj_by_area(structure_name=areas,
-                             normalize_source=True,
-                             normalize_target=False,
-                             fname=f'proj_by_area_justus/{nucleus[0]}{brain[-3:]}_filter-{area_filter}'
-                                   f'_source-norm_proj_by_area.pickle')
-        pp.save_proj_by_area(structure_name=areas,
-                             normalize_source=False,
-                             normalize_target=False,
-                             fname=f'proj_by_area_justus/{nucleus[0]}{brain[-3:]}_filter-{area_filter}'
-                                   f'_no-norm_proj_by_area.pickle')
+# Every filter is projected from the same image load, e.g. add 'Ventral medial nucleus of the thalamus' to compare
+area_filters = ['Thalamus']
+threshold = 0.2
+
+# Set up in the parent process before the worker pool is forked, so that every worker shares its voxel array
+# (and its already built structure masks) copy-on-write instead of loading its own.
+pp: ProjPredictor = None
+areas: list = None
+ledger: BatchLedger = None
+params: str = None
+parquet_root: str = None
+_blas_limits = None
+
+
+def pending_units(nucleus: tuple, brain_dir: str, brain: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """Returns the hash of a brain's input image and the (filter, variant) pairs of it that the ledger doesn't
+    have as done."""
+    input_hash = ledger.file_hash(brain_dir + brain + image_path)
+    pending = [(area_filter, variant) for area_filter in area_filters for variant in ('raw_proj', 'proj_by_area')
+               if not ledger.is_done(nucleus[0], brain, area_filter, variant, input_hash, params)]
+    return input_hash, pending
+
+
+def prepare_job(job: tuple) -> Union[tuple, None]:
+    """Hashes a job's image (on an ImagePrefetcher thread) and returns the job with its input hash and pending
+    units, None if nothing is pending, or the job as it is if the image can't be hashed or the ledger can't be
+    read, so that process_brain tries again and records the failure."""
+    try:
+        input_hash, pending = pending_units(*job)
+    except Exception:
+        return job
+    return job + (input_hash, pending) if pending else None
+
+
+def process_brain(nucleus: tuple,
+                  brain_dir: str,
+                  brain: str,
+                  input_hash: str = None,
+                  pending: List[Tuple[str, str]] = None,
+                  load_image: Callable[[], np.array] = None) -> None:
+    """Writes the outputs of one brain that the ledger doesn't have as done yet. A failure is recorded in the
+    ledger with its traceback instead of stopping the batch. The input hash and pending units are looked up
+    here unless given (see prepare_job). If given, load_image returns the already read and resized image (see
+    ImagePrefetcher with orient=False), otherwise the image is read here."""
+    try:
+        if pending is None:
+            input_hash, pending = pending_units(nucleus, brain_dir, brain)
+    except Exception:
+        # The image can't be read to hash it (e.g. it is missing), so every unit of the brain fails
+        for area_filter, variant in itertools.product(area_filters, ('raw_proj', 'proj_by_area')):
+            ledger.mark_failed(nucleus[0], brain, area_filter, variant, '', params, traceback.format_exc())
+        return
+    if not pending:
+        return
+    try:
+        if load_image is not None:
+            pp.set_raw_image(load_image(), source_area=nucleus[1])
+        else:
+            pp.set_image_from_file(brain_dir + brain + image_path, source_area=nucleus[1], reshape=True)
+        pending_filters = [area_filter for area_filter in area_filters
+                           if any(unit[0] == area_filter for unit in pending)]
+        pp.vol_to_probs_by_filter(pending_filters, threshold)
+        for area_filter in pending_filters:
+            pp.select_filter(area_filter)
+            if (area_filter, 'raw_proj') in pending:
+                pp.save_projections(f'raw_proj/{nucleus[0]}{brain[-3:]}_filter-{area_filter}_raw_proj.tiff')
+                ledger.mark_done(nucleus[0], brain, area_filter, 'raw_proj', input_hash, params)
+                pending.remove((area_filter, 'raw_proj'))
+            if (area_filter, 'proj_by_area') in pending:
+                if parquet_root is not None:
+                    pp.append_proj_by_area_dataset(structure_name=areas, root=parquet_root,
+                                                   brain=f'{nucleus[0]}{brain[-3:]}')
+                else:
+                    pp.save_proj_by_area_variants(structure_name=areas,
+                                                  fname=f'proj_by_area_justus/{nucleus[0]}{brain[-3:]}'
+                                                        f'_filter-{area_filter}_all-norm_proj_by_area.pickle',
+                                                  long_form=True)
+                ledger.mark_done(nucleus[0], brain, area_filter, 'proj_by_area', input_hash, params)
+                pending.remove((area_filter, 'proj_by_area'))
+    except Exception:
+        for area_filter, variant in pending:
+            ledger.mark_failed(nucleus[0], brain, area_filter, variant, input_hash, params, traceback.format_exc())
+
+
+def _process_job(job: tuple) -> None:
+    process_brain(*job)
+
+
+def _init_worker(blas_threads: int) -> None:
+    # Keep each worker's BLAS to its share of the cores so the workers don't oversubscribe the node
+    global _blas_limits
+    _blas_limits = threadpool_limits(limits=blas_threads)
+
+
+def main() -> None:
+    global pp, areas, ledger, params, parquet_root
+    parser = argparse.ArgumentParser(description='Predicts the projections of every brain of every nucleus.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes to spread the brains over.')
+    parser.add_argument('--blas-threads', type=int, default=None,
+                        help='BLAS threads per worker. Defaults to the number of cores divided by the workers.')
+    parser.add_argument('--snapshot-dir', default=None,
+                        help='Memory map the voxel array from this ProjPredictor.save_snapshot directory.')
+    parser.add_argument('--ledger', default='batch_ledger.sqlite',
+                        help='SQLite file recording finished and failed work, so a rerun skips finished brains.')
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help='Number of images read ahead on background threads when running serially (0 for none).')
+    parser.add_argument('--trace', default=None,
+                        help='Record the time and memory of every ProjPredictor call, print a summary at the end and '
+                             'write a Chrome trace to this file. Only for serial runs.')
+    parser.add_argument('--parquet', default=None,
+                        help='Append the projections by area to the Parquet dataset at this directory instead of '
+                             'writing a pickle per brain.')
+    parser.add_argument('--dtype', default=None, choices=['float32', 'float64'],
+                        help='Floating point type to compute the projections in. Defaults to that of the voxel array.')
+    parser.add_argument('--result-cache', default=None,
+                        help='Look projections up in and add them to the on-disk result cache at this directory, '
+                             'which can be shared with the notebook.')
+    args = parser.parse_args()
+    parquet_root = args.parquet
+
+    areas = pd.read_csv('annotation_info_0118_1327.csv')
+    areas = areas[areas['consider'] == 1]['name'].values.tolist()
+    ledger = BatchLedger(args.ledger)
+    params = ledger.params_key({'image_path': image_path, 'threshold': threshold, 'reshape': True, 'areas': areas,
+                                'parquet': parquet_root, 'dtype': args.dtype,
+                                # Brains written with the wide all-norm pickles are written again in the long layout
+                                'proj_by_area_layout': 'long'})
+    start = time.perf_counter()
+    pp = ProjPredictor(verbose=False, snapshot_dir=args.snapshot_dir, dtype=args.dtype,
+                       result_cache=ResultCache(args.result_cache) if args.result_cache is not None else None)
+    # Build the shared structure masks once here rather than once per worker
+    pp.region_aggregation_matrix(pp.struct_names_to_ids(areas))
+    for area_filter in area_filters:
+        pp.compile_filter(area_filter)
+    if pp.result_cache is not None:
+        # Hash the voxel array once here, rather than once per worker on its first result cache lookup
+        pp.model_version
+    print(f'Predictor startup took {time.perf_counter() - start:.1f} s')
+    if args.trace is not None:
+        if args.workers > 1:
+            parser.error('--trace only works for serial runs')
+        pp.instrumentation = Instrumentation()
+
+    jobs = []
+    for nucleus in nuclei:
+        d = f'datafornomi/{nucleus[0]}fornomi/'
+        brains = os.listdir(d)
+        brains = [brain for brain in brains if not brain.startswith('.')]
+        jobs += [(nucleus, d, brain) for brain in brains]
+
+    if args.workers == 1 and args.prefetch > 0:
+        # The images are hashed on the prefetch threads, and those with nothing pending are never read
+        prefetcher = ImagePrefetcher(jobs, lambda job: job[1] + job[2] + image_path, depth=args.prefetch,
+                                     default_shape=pp.default_shape, prepare=prepare_job, orient=False)
+        process_time = 0.0
+        processed = 0
+        for job, load_image in tqdm(prefetcher, total=len(jobs)):
+            process_start = time.perf_counter()
+            process_brain(*job, load_image=load_image)
+            process_time += time.perf_counter() - process_start
+            processed += 1
+        print(prefetcher.report())
+        # Waiting on images happens while iterating over the prefetcher, so it isn't part of the process time
+        print(f'process: {processed} images in {process_time:.2f} s '
+              f'({processed / process_time if process_time > 0 else float("inf"):.1f} images/s)')
+    elif args.workers == 1:
+        for job in tqdm(jobs):
+            _process_job(job)
+    else:
+        blas_threads = args.blas_threads or max(1, os.cpu_count() // args.workers)
+        with multiprocessing.get_context('fork').Pool(args.workers,
+                                                       initializer=_init_worker,
+                                                       initargs=(blas_threads,)) as pool:
+            for _ in tqdm(pool.imap_unordered(_process_job, jobs), total=len(jobs)):
+                pass
+
+    if pp.instrumentation is not None:
+        print(pp.instrumentation.summary().to_string())
+        pp.instrumentation.to_chrome_trace(args.trace)
+
+    failures = ledger.failures()
+    if failures:
+        print(f'{len(failures)} units failed, see the units table of {args.ledger} for their tracebacks')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import numpy as np
+import os
+import pytest
+import sqlite3
+from skimage import io
+import BatchProjPred
+import ProjDataset
+from BatchLedger import BatchLedger
+from ImagePrefetcher import ImagePrefetcher
+from ProjPredictor import ProjPredictor
+from SyntheticCache import SyntheticVoxelModelCache
+
+NUCLEUS = ('DN', 'Dentate nucleus')
+AREAS = ['Somatomotor areas', 'Thalamus', 'Cerebellar nuclei']
+
+
+@pytest.fixture(scope='module')
+def predictor() -> ProjPredictor:
+    return ProjPredictor(cache=SyntheticVoxelModelCache(seed=0))
+
+
+@pytest.fixture
+def batch(tmp_path, monkeypatch, predictor):
+    """Sets up BatchProjPred's globals as main() does, in a directory with two brains with images and one
+    without."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('raw_proj')
+    os.makedirs('proj_by_area_justus')
+    brain_dir = 'datafornomi/DNfornomi/'
+    rng = np.random.default_rng(0)
+    for brain in ('brain001', 'brain002'):
+        os.makedirs(os.path.dirname(brain_dir + brain + BatchProjPred.image_path))
+        io.imsave(brain_dir + brain + BatchProjPred.image_path, rng.random((65, 88, 88), dtype=np.float32),
+                  check_contrast=False)
+    os.makedirs(brain_dir + 'brain003')
+    monkeypatch.setattr(BatchProjPred, 'pp', predictor)
+    monkeypatch.setattr(BatchProjPred, 'areas', AREAS)
+    monkeypatch.setattr(BatchProjPred, 'area_filters', ['Cerebellar nuclei'])
+    monkeypatch.setattr(BatchProjPred, 'threshold', 0.9)
+    monkeypatch.setattr(BatchProjPred, 'ledger', BatchLedger('ledger.sqlite'))
+    monkeypatch.setattr(BatchProjPred, 'params', BatchLedger.params_key({'threshold': 0.9}))
+    monkeypatch.setattr(BatchProjPred, 'parquet_root', None)
+    return [(NUCLEUS, brain_dir, brain) for brain in ('brain001', 'brain002', 'brain003')]
+
+
+def run_prefetched(jobs):
+    """The serial prefetch loop of main()."""
+    prefetcher = ImagePrefetcher(jobs, lambda job: job[1] + job[2] + BatchProjPred.image_path,
+                                 prepare=BatchProjPred.prepare_job, orient=False)
+    for job, load_image in prefetcher:
+        BatchProjPred.process_brain(*job, load_image=load_image)
+
+
+def test_ledger_errors_while_preparing_fail_the_brain_not_the_run(batch, monkeypatch):
+    is_done = BatchLedger.is_done
+
+    def locked_for_brain001(self, nucleus, brain, *args):
+        if brain == 'brain001':
+            raise sqlite3.OperationalError('database is locked')
+        return is_done(self, nucleus, brain, *args)
+
+    monkeypatch.setattr(BatchLedger, 'is_done', locked_for_brain001)
+    assert BatchProjPred.prepare_job(batch[0]) == batch[0]
+    run_prefetched(batch)
+    failed = {(brain, variant) for _, brain, _, variant, _ in BatchProjPred.ledger.failures()}
+    assert failed == {('brain001', 'raw_proj'), ('brain001', 'proj_by_area'),
+                      ('brain003', 'raw_proj'), ('brain003', 'proj_by_area')}
+    assert os.listdir('raw_proj') == ['DN002_filter-Cerebellar nuclei_raw_proj.tiff']
+
+
+def test_missing_image_is_recorded_as_failed_with_traceback(batch):
+    for job in batch:
+        BatchProjPred.process_brain(*job)
+    failures = BatchProjPred.ledger.failures()
+    assert sorted((brain, variant) for _, brain, _, variant, _ in failures) == [('brain003', 'proj_by_area'),
+                                                                                ('brain003', 'raw_proj')]
+    for _, _, _, _, traceback in failures:
+        assert 'FileNotFoundError' in traceback
+    assert sorted(os.listdir('proj_by_area_justus')) == \
+        ['DN001_filter-Cerebellar nuclei_all-norm_proj_by_area.pickle',
+         'DN002_filter-Cerebellar nuclei_all-norm_proj_by_area.pickle']
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_rerun_skips_done_units(batch, monkeypatch, prefetch):
+    def run():
+        if prefetch:
+            run_prefetched(batch)
+        else:
+            for job in batch:
+                BatchProjPred.process_brain(*job)
+
+    run()
+    processed = []
+    set_raw_image = ProjPredictor.set_raw_image
+    monkeypatch.setattr(ProjPredictor, 'set_raw_image',
+                        lambda self, image, *args, **kwargs: (processed.append(image.shape),
+                                                              set_raw_image(self, image, *args, **kwargs)))
+    # Only the brain with a missing image is tried again
+    run()
+    assert processed == []
+    assert len(BatchProjPred.ledger.failures()) == 2
+
+    # A changed image makes its brain's units pending again, and only that brain is processed
+    image_file = batch[1][1] + batch[1][2] + BatchProjPred.image_path
+    io.imsave(image_file, np.random.default_rng(1).random((65, 88, 88), dtype=np.float32), check_contrast=False)
+    run()
+    assert len(processed) == 1
+
+
+def test_rerun_after_only_some_units_are_done(batch):
+    job = batch[0]
+    input_hash, pending = BatchProjPred.pending_units(*job)
+    assert len(pending) == 2
+    BatchProjPred.ledger.mark_done(NUCLEUS[0], job[2], 'Cerebellar nuclei', 'raw_proj', input_hash,
+                                   BatchProjPred.params)
+    BatchProjPred.process_brain(*job)
+    # Only the proj_by_area unit was pending, so no projections image was written
+    assert os.listdir('raw_proj') == []
+    assert os.listdir('proj_by_area_justus') == ['DN001_filter-Cerebellar nuclei_all-norm_proj_by_area.pickle']
+    assert BatchProjPred.pending_units(*job)[1] == []
+
+
+def test_rerun_after_crashing_before_recording_done_does_not_duplicate_parquet_rows(batch, monkeypatch):
+    monkeypatch.setattr(BatchProjPred, 'parquet_root', 'dataset')
+    BatchProjPred.process_brain(*batch[0])
+    rows = ProjDataset.load_dataset('dataset')
+    # As if the batch crashed after appending the rows but before the ledger recorded them
+    monkeypatch.setattr(BatchProjPred, 'ledger', BatchLedger('fresh_ledger.sqlite'))
+    BatchProjPred.process_brain(*batch[0])
+    assert len(ProjDataset.load_dataset('dataset')) == len(rows) == 4 * len(AREAS)
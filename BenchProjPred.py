@@ -0,0 +1,160 @@
+from ProjPredictor import ProjPredictor
+from SyntheticCache import SyntheticVoxelModelCache, DEFAULT_STRUCTURES
+import argparse
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from typing import Callable
+
+areas = [name for _, name, _, parent in DEFAULT_STRUCTURES if parent == 315]
+area_filter = 'Thalamus'
+threshold = 0.2
+
+
+def time_stage(run: Callable[[], None], setup: Callable[[], None] = None, repeats: int = 5) -> dict:
+    """Times run repeats times, calling setup (untimed) before each run, and summarizes the wall times."""
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {'mean_s': float(np.mean(times)), 'min_s': float(np.min(times)), 'max_s': float(np.max(times)),
+            'repeats': repeats}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Times each stage of processing a brain against a synthetic '
+                                                 'voxel model at the 100um grid and writes the results as JSON.')
+    parser.add_argument('--rank', type=int, default=32, help='Rank of the synthetic voxel array.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic voxel model and image.')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of timed runs of each stage.')
+    parser.add_argument('--raw-shape', type=int, nargs=3, default=[130, 176, 176],
+                        help='Shape of the synthetic TIFF, which is resized to the default shape.')
+    parser.add_argument('--dense-max-voxels', type=int, default=256,
+                        help='The dense gather builds an (n_selected x n_targets) block, so it is timed on at most '
+                             'this many selected voxels and also reported per voxel.')
+    parser.add_argument('--dtype', default='float64', choices=['float32', 'float64'],
+                        help='Floating point type of the synthetic voxel array and of the projections.')
+    parser.add_argument('--no-incremental', action='store_true',
+                        help='Sum the weight rows of the selected voxels from scratch on every projection instead of '
+                             'updating the previous sum with the voxels that changed.')
+    parser.add_argument('--output', default='bench_output.json', help='JSON file to write the results to.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    cache = SyntheticVoxelModelCache(rank=args.rank, seed=args.seed)
+    pp = ProjPredictor(cache=cache, source_area='Dentate nucleus', dtype=args.dtype,
+                       incremental=not args.no_incremental)
+    setup_s = time.perf_counter() - start
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        from skimage import io
+        from skimage.transform import resize
+        image_file = os.path.join(tmp, 'image.tif')
+        io.imsave(image_file, rng.random(args.raw_shape, dtype=np.float32), check_contrast=False)
+        raw = io.imread(image_file)
+        resized = resize(raw, pp.default_shape)
+        oriented = pp.orient_image(resized)
+        filter_ids = pp.struct_names_to_ids(area_filter)
+        pp.struct_ids_to_mask(filter_ids)
+
+        def load_oriented():
+            # Every timed run starts from a fresh image, so none of them updates the weight sum of the run before
+            pp.set_oriented_image(oriented)
+            pp.reset_incremental()
+
+        def load_thresholded():
+            load_oriented()
+            pp.threshold(threshold)
+
+        def load_selected():
+            load_oriented()
+            pp.threshold(threshold)
+            pp.filter_by_name(area_filter)
+
+        def load_projected():
+            load_oriented()
+            pp.select_source(threshold, area_filter)
+            pp.vol_to_probs(save=False)
+
+        stages = {'imread': time_stage(lambda: io.imread(image_file), repeats=args.repeats),
+                  'resize': time_stage(lambda: resize(raw, pp.default_shape), repeats=args.repeats),
+                  '_permute_pad_reflect': time_stage(lambda: pp.orient_image(resized), repeats=args.repeats),
+                  'mask_raw_image': time_stage(lambda: pp.mask_raw_image(resized), repeats=args.repeats),
+                  'threshold': time_stage(lambda: pp.threshold(threshold), load_oriented, repeats=args.repeats),
+                  'filter_by_name': time_stage(lambda: pp.filter_by_name(area_filter), load_thresholded,
+                                               repeats=args.repeats),
+                  'vol_to_probs': time_stage(pp.vol_to_probs, load_selected, repeats=args.repeats)}
+        load_selected()
+        pp.vol_to_probs()
+        stages['save_projections'] = time_stage(lambda: pp.save_projections(os.path.join(tmp, 'proj.tiff')),
+                                                repeats=args.repeats)
+        stages['save_proj_by_area'] = time_stage(
+            lambda: pp.save_proj_by_area(areas, True, True, fname=os.path.join(tmp, 'proj_by_area.pickle')),
+            repeats=args.repeats)
+        stages['save_proj_by_area_variants'] = time_stage(
+            lambda: pp.save_proj_by_area_variants(areas, fname=os.path.join(tmp, 'proj_by_area.pickle')),
+            repeats=args.repeats)
+
+        selected, _ = pp._current_source_weights()
+        n_selected = len(selected)
+        dense_voxels = min(args.dense_max_voxels, n_selected)
+        dense = time_stage(lambda: pp._voxel_array[selected[:dense_voxels]].sum(axis=0), repeats=args.repeats)
+        dense['n_voxels'] = dense_voxels
+        dense['per_voxel_s'] = dense['mean_s'] / max(dense_voxels, 1)
+        precision = pp.precision_error()
+        pp.build_region_model(areas)
+        sweep_thresholds = np.linspace(0.02, 0.98, 50)
+        strategies = {'dense_gather': dense,
+                      'factorized': time_stage(lambda: pp.vol_to_probs(save=False), load_selected,
+                                               repeats=args.repeats),
+                      'fused_select_factorized': time_stage(lambda: (pp.select_source(threshold, area_filter),
+                                                                     pp.vol_to_probs(save=False)),
+                                                            load_oriented, repeats=args.repeats),
+                      # Nudging the threshold after projecting, which only updates the weight sum when incremental
+                      'incremental_nudge': time_stage(lambda: (pp.select_source(threshold + 0.002, area_filter),
+                                                               pp.vol_to_probs(save=False)),
+                                                      load_projected, repeats=args.repeats),
+                      'region_reduced': time_stage(pp.region_profile, load_selected, repeats=args.repeats),
+                      'threshold_sweep_50': time_stage(lambda: pp.threshold_sweep(sweep_thresholds, area_filter),
+                                                       load_oriented, repeats=args.repeats)}
+
+    results = {'commit': git_commit(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'platform': platform.platform(),
+               'config': {'rank': args.rank, 'seed': args.seed, 'dtype': args.dtype,
+                          'incremental': pp.incremental, 'raw_shape': args.raw_shape,
+                          'annotation_shape': list(cache.annotation_shape),
+                          'n_source_voxels': int(pp._voxel_array.weights.shape[0]),
+                          'n_target_voxels': int(pp._voxel_array.nodes.shape[1]),
+                          'n_selected_voxels': n_selected, 'n_areas': len(areas), 'setup_s': setup_s},
+               'stages': stages,
+               'strategies': strategies,
+               'precision': precision}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for group, label in (('stages', 'stage'), ('strategies', 'strategy')):
+        for name, timing in results[group].items():
+            print(f'{label:>8} {name:<28} {timing["mean_s"] * 1000:10.2f} ms')
+    print(f'{args.dtype} max relative error {precision["max_rel_error"]:.2e} '
+          f'(bound {precision["max_rel_error_bound"]:.2e})')
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
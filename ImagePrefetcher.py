@@ -0,0 +1,152 @@
+from ProjPredictor import ProjPredictor
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import numpy as np
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Tuple, Any, Union
+
+
+class ImagePrefetcher:
+    """Reads, resizes and orients the images of upcoming items on background threads while the current one is
+    being projected, so TIFF decoding overlaps with compute.
+
+    Iterating over it yields (item, load) pairs in the order of the items, where load() returns the oriented
+    image of that item (ready for ProjPredictor.set_oriented_image), or if not orienting, the resized image (ready
+    for ProjPredictor.set_raw_image), raising any error hit while loading it.
+    At most depth images are loaded ahead of the one being consumed.
+
+    If given, prepare is run on each item on the background threads before its image is read, e.g. to check
+    whether it still needs processing. It returns the item to yield in its place, or None to skip the item
+    without reading its image. If it raises, the item itself is yielded without reading its image, and load()
+    raises the error.
+
+    Attributes
+    ----------
+    depth : int
+        The number of images to load ahead
+    stage_times : dict
+        The total seconds spent in, and number of items through, each stage: prepare, read, resize, orient, and
+        wait (time the consumer was blocked on an item that wasn't loaded yet)
+    """
+    def __init__(self,
+                 items: Iterable[Any],
+                 image_file: Callable[[Any], str],
+                 y_mirror: bool = False,
+                 reshape: bool = True,
+                 default_shape: Tuple[int, int, int] = (65, 88, 88),
+                 depth: int = 4,
+                 threads: int = 2,
+                 prepare: Callable[[Any], Any] = None,
+                 orient: bool = True) -> None:
+        """
+
+        Parameters
+        ----------
+        items : Iterable[Any]
+            The items to load images for, e.g. batch jobs.
+        image_file : Callable[[Any], str]
+            A function giving the image filename of an item.
+        y_mirror : bool
+            Whether the images should be mirrored along the median plane.
+        reshape : bool
+            Whether to resize the images to default_shape before orienting them.
+        default_shape : Tuple[int, int, int]
+            The shape to resize images to, as ProjPredictor.default_shape.
+        depth : int
+            The number of images to load ahead.
+        threads : int
+            The number of background threads loading images.
+        prepare : Callable[[Any], Any]
+            A function run on each item before its image is read, returning the item to yield or None to skip it.
+        orient : bool
+            Whether to orient the images. Images for ProjPredictor.set_raw_image are left as they are.
+        """
+        self.items = items
+        self.image_file = image_file
+        self.y_mirror = y_mirror
+        self.reshape = reshape
+        self.default_shape = default_shape
+        self.depth = depth
+        self.threads = threads
+        self.prepare = prepare
+        self.orient = orient
+        self.stage_times = {stage: [0.0, 0] for stage in ('prepare', 'read', 'resize', 'orient', 'wait')}
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[Tuple[Any, Callable[[], np.array]]]:
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            items = iter(self.items)
+            in_flight = deque()
+            for item in items:
+                in_flight.append(executor.submit(self._load, item))
+                if len(in_flight) > self.depth:
+                    break
+            while in_flight:
+                prepared, image = self._wait(in_flight.popleft())
+                for next_item in items:
+                    in_flight.append(executor.submit(self._load, next_item))
+                    break
+                if prepared is not None:
+                    yield prepared, lambda image=image: self._unwrap(image)
+
+    def report(self) -> str:
+        """Summarizes the time spent in and the throughput of each stage."""
+        lines = []
+        for stage, (seconds, count) in self.stage_times.items():
+            rate = count / seconds if seconds > 0 else float('inf')
+            lines.append(f'{stage:>6}: {count} images in {seconds:.2f} s ({rate:.1f} images/s)')
+        return '\n'.join(lines)
+
+    def _load(self, item: Any) -> Tuple[Any, Union[np.array, Exception]]:
+        """Prepares an item and loads its image. Errors preparing the item or loading the image are returned rather
+        than raised, so that they are raised by the consumer's load() instead of ending the iteration."""
+        prepared = item
+        if self.prepare is not None:
+            start = time.perf_counter()
+            try:
+                prepared = self.prepare(item)
+            except Exception as error:
+                return item, error
+            finally:
+                self._record('prepare', start)
+            if prepared is None:
+                return None, None
+        try:
+            return prepared, self._load_image(item)
+        except Exception as error:
+            return prepared, error
+
+    def _load_image(self, item: Any) -> np.array:
+        from skimage import io
+        start = time.perf_counter()
+        image = io.imread(self.image_file(item))
+        self._record('read', start)
+        if self.reshape:
+            from skimage.transform import resize
+            start = time.perf_counter()
+            image = resize(image, self.default_shape)
+            self._record('resize', start)
+        if self.orient:
+            start = time.perf_counter()
+            image = np.ascontiguousarray(ProjPredictor.orient_image(image, self.y_mirror))
+            self._record('orient', start)
+        return image
+
+    def _wait(self, future) -> Tuple[Any, Union[np.array, Exception]]:
+        start = time.perf_counter()
+        try:
+            return future.result()
+        finally:
+            self._record('wait', start)
+
+    @staticmethod
+    def _unwrap(image: Union[np.array, Exception]) -> np.array:
+        if isinstance(image, Exception):
+            raise image
+        return image
+
+    def _record(self, stage: str, start: float) -> None:
+        with self._lock:
+            self.stage_times[stage][0] += time.perf_counter() - start
+            self.stage_times[stage][1] += 1
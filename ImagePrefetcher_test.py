@@ -0,0 +1,62 @@
+import numpy as np
+import os
+import pytest
+from skimage import io
+from ImagePrefetcher import ImagePrefetcher
+from ProjPredictor import ProjPredictor
+
+
+@pytest.fixture
+def image_files(tmp_path):
+    rng = np.random.default_rng(0)
+    files = {}
+    for name in ('a', 'b', 'c'):
+        files[name] = os.path.join(tmp_path, f'{name}.tif')
+        io.imsave(files[name], rng.random((65, 88, 88), dtype=np.float32), check_contrast=False)
+    return files
+
+
+def test_yields_items_in_order_with_their_images(image_files):
+    prefetcher = ImagePrefetcher(list(image_files), image_files.get, reshape=False, depth=1)
+    loaded = [(item, load()) for item, load in prefetcher]
+    assert [item for item, _ in loaded] == list(image_files)
+    for item, image in loaded:
+        np.testing.assert_array_equal(image, ProjPredictor.orient_image(io.imread(image_files[item])))
+
+
+def test_image_errors_are_raised_by_load(image_files):
+    image_files['missing'] = os.path.join(os.path.dirname(image_files['a']), 'missing.tif')
+    loads = dict(ImagePrefetcher(['a', 'missing', 'b'], image_files.get, reshape=False, orient=False))
+    assert list(loads) == ['a', 'missing', 'b']
+    with pytest.raises(OSError):
+        loads['missing']()
+    assert loads['b']().shape == (65, 88, 88)
+
+
+def test_prepare_skips_and_replaces_items(image_files):
+    read = []
+
+    def image_file(item):
+        read.append(item)
+        return image_files[item]
+
+    prefetcher = ImagePrefetcher(['a', 'b', 'c'], image_file, reshape=False,
+                                 prepare=lambda item: None if item == 'b' else item.upper(),
+                                 orient=False)
+    assert [item for item, _ in prefetcher] == ['A', 'C']
+    # Skipped items are never read
+    assert sorted(read) == ['a', 'c']
+
+
+def test_prepare_errors_are_raised_by_load(image_files):
+    def prepare(item):
+        if item == 'b':
+            raise RuntimeError('database is locked')
+        return item
+
+    loads = dict(ImagePrefetcher(['a', 'b', 'c'], image_files.get, reshape=False, prepare=prepare, orient=False))
+    # The failing item is still yielded, and the ones after it are still loaded
+    assert list(loads) == ['a', 'b', 'c']
+    with pytest.raises(RuntimeError, match='database is locked'):
+        loads['b']()
+    assert loads['c']().shape == (65, 88, 88)
@@ -0,0 +1,153 @@
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+import json
+import os
+import pandas as pd
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, List
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the resident set size isn't recorded
+    resource = None
+
+
+class Instrumentation:
+    """Records the wall time, CPU time and memory of named spans of work, e.g. ProjPredictor method calls.
+
+    Every finished span is appended to records as a dictionary and passed to each registered hook. Memory is the
+    peak resident set size of the process after the span (and how much the span raised it) and, if trace_memory
+    is set, the peak of the Python allocations traced by tracemalloc during the span over those at its start.
+    The resident set size is recorded as 0 on platforms without the resource module (Windows).
+
+    CPU time is recorded twice. cpu_s is the CPU time of the whole process, so it includes the threads BLAS and
+    other native libraries run the matrix products on, but also any other Python threads working at the same time
+    (e.g. image prefetching). thread_cpu_s is the CPU time of the span's own thread only, so it leaves both out.
+
+    Attributes
+    ----------
+    records : List[dict]
+        One dictionary per finished span: name, thread, start_s (since the instrumentation was made), wall_s,
+        cpu_s, thread_cpu_s, peak_rss_kb, rss_increase_kb, and traced_peak_kb if tracing memory
+    hooks : List[Callable[[dict], None]]
+        Functions called with the record of every finished span
+    trace_memory : bool
+        Whether Python allocations are traced with tracemalloc, which slows allocation heavy code down
+    """
+    def __init__(self, trace_memory: bool = False) -> None:
+        self.records: List[dict] = []
+        self.hooks: List[Callable[[dict], None]] = []
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Callable[[dict], None]) -> None:
+        """Registers a function to be called with the record of every finished span."""
+        self.hooks.append(hook)
+
+    @contextmanager
+    def span(self, name: str):
+        """Records the work done inside the with block as a span with the given name."""
+        stack = self._local.__dict__.setdefault('stack', [])
+        if self.trace_memory:
+            # The traced peak is reset for every span, so pass the peak so far up to the enclosing span first
+            if stack:
+                stack[-1]['traced_peak'] = max(stack[-1]['traced_peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+            stack.append({'traced_start': traced_start, 'traced_peak': traced_start})
+        rss_start = _peak_rss_kb()
+        cpu_start = time.process_time()
+        thread_cpu_start = time.thread_time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+            thread_cpu = time.thread_time() - thread_cpu_start
+            peak_rss = _peak_rss_kb()
+            record = {'name': name,
+                      'thread': threading.get_ident(),
+                      'start_s': start - self._origin,
+                      'wall_s': wall,
+                      'cpu_s': cpu,
+                      'thread_cpu_s': thread_cpu,
+                      'peak_rss_kb': peak_rss,
+                      'rss_increase_kb': peak_rss - rss_start}
+            if self.trace_memory:
+                frame = stack.pop()
+                traced_peak = max(frame['traced_peak'], tracemalloc.get_traced_memory()[1])
+                record['traced_peak_kb'] = (traced_peak - frame['traced_start']) / 1024
+                if stack:
+                    stack[-1]['traced_peak'] = max(stack[-1]['traced_peak'], traced_peak)
+            with self._lock:
+                self.records.append(record)
+            for hook in self.hooks:
+                hook(record)
+
+    def summary(self) -> pd.DataFrame:
+        """Summarizes the spans by name: number of calls, total and mean wall time, total process and thread CPU
+        time, and the largest memory figures of any call. Sorted by total wall time."""
+        if not self.records:
+            return pd.DataFrame()
+        df = pd.DataFrame(self.records)
+        aggregations = {'calls': ('wall_s', 'size'),
+                        'total_wall_s': ('wall_s', 'sum'),
+                        'mean_wall_s': ('wall_s', 'mean'),
+                        'total_cpu_s': ('cpu_s', 'sum'),
+                        'total_thread_cpu_s': ('thread_cpu_s', 'sum'),
+                        'max_rss_increase_kb': ('rss_increase_kb', 'max'),
+                        'peak_rss_kb': ('peak_rss_kb', 'max')}
+        if 'traced_peak_kb' in df.columns:
+            aggregations['max_traced_peak_kb'] = ('traced_peak_kb', 'max')
+        return df.groupby('name').agg(**aggregations).sort_values('total_wall_s', ascending=False)
+
+    def to_chrome_trace(self, fname: str) -> None:
+        """Writes the spans as a Chrome trace (viewable in chrome://tracing or Perfetto)."""
+        events = [{'name': record['name'],
+                   'ph': 'X',
+                   'ts': record['start_s'] * 1e6,
+                   'dur': record['wall_s'] * 1e6,
+                   'pid': os.getpid(),
+                   'tid': record['thread'],
+                   'args': {key: value for key, value in record.items()
+                            if key not in ('name', 'thread', 'start_s', 'wall_s')}}
+                  for record in self.records]
+        with open(fname, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _peak_rss_kb() -> int:
+    if resource is None:
+        return 0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    return peak_rss // 1024 if sys.platform == 'darwin' else peak_rss
+
+
+def span(instrumentation: Instrumentation, name: str):
+    """Returns instrumentation.span(name), or a context manager that does nothing if instrumentation is None."""
+    if instrumentation is None:
+        return nullcontext()
+    return instrumentation.span(name)
+
+
+def instrumented(method: Callable) -> Callable:
+    """Decorates a method so that each call is recorded as a span of the object's instrumentation attribute, named
+    after the class and method. Calls go straight through when the instrumentation is None."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        instrumentation = getattr(self, 'instrumentation', None)
+        if instrumentation is None:
+            return method(self, *args, **kwargs)
+        with instrumentation.span(f'{type(self).__name__}.{method.__name__}'):
+            return method(self, *args, **kwargs)
+    return wrapper
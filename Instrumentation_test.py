@@ -0,0 +1,43 @@
+import numpy as np
+from types import SimpleNamespace
+import Instrumentation
+from Instrumentation import Instrumentation as Recorder
+
+
+def test_span_records_wall_and_cpu_time():
+    instrumentation = Recorder()
+    with instrumentation.span('outer'):
+        with instrumentation.span('inner'):
+            np.random.default_rng(0).random((500, 500)) @ np.random.default_rng(1).random((500, 500))
+    assert [record['name'] for record in instrumentation.records] == ['inner', 'outer']
+    for record in instrumentation.records:
+        assert record['wall_s'] > 0
+        assert record['cpu_s'] >= 0 and record['thread_cpu_s'] >= 0
+    summary = instrumentation.summary()
+    assert list(summary.index) == ['outer', 'inner']
+    assert {'total_cpu_s', 'total_thread_cpu_s'} <= set(summary.columns)
+
+
+def test_peak_rss_is_in_kilobytes_on_macos(monkeypatch):
+    class FakeResource:
+        RUSAGE_SELF = 0
+
+        @staticmethod
+        def getrusage(who):
+            return SimpleNamespace(ru_maxrss=2048 * 1024)
+
+    monkeypatch.setattr(Instrumentation, 'resource', FakeResource)
+    monkeypatch.setattr(Instrumentation.sys, 'platform', 'linux')
+    assert Instrumentation._peak_rss_kb() == 2048 * 1024
+    # ru_maxrss is in bytes on macOS
+    monkeypatch.setattr(Instrumentation.sys, 'platform', 'darwin')
+    assert Instrumentation._peak_rss_kb() == 2048
+
+
+def test_no_rss_without_resource_module(monkeypatch):
+    monkeypatch.setattr(Instrumentation, 'resource', None)
+    instrumentation = Recorder()
+    with instrumentation.span('span'):
+        pass
+    assert instrumentation.records[0]['peak_rss_kb'] == 0
+    assert instrumentation.records[0]['rss_increase_kb'] == 0
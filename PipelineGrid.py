@@ -0,0 +1,217 @@
+from ProjPredictor import ProjPredictor, NORMALIZATION_COLUMNS, proj_by_area_frame
+from ProjDataset import NORMALIZATION_NAMES
+from collections import OrderedDict
+import itertools
+import numpy as np
+import pandas as pd
+import time
+from typing import Any, Dict, List, Tuple, Union
+
+# The stages of the pipeline in order, each with the stage its input comes from and the grid parameters its result
+# depends on. Results are cached keyed by those parameters, so e.g. one resized image serves both y_mirrors and one
+# thresholded vector serves every filter area. Normalization only picks columns of the aggregated table.
+STAGES = OrderedDict([('load', (None, ('brain',))),
+                      ('resize', ('load', ('brain',))),
+                      ('orient', ('resize', ('brain', 'y_mirror'))),
+                      ('threshold', ('orient', ('brain', 'y_mirror', 'threshold'))),
+                      ('filter', ('threshold', ('brain', 'y_mirror', 'threshold', 'filter_area'))),
+                      ('project', ('filter', ('brain', 'y_mirror', 'threshold', 'filter_area'))),
+                      ('aggregate', ('project', ('brain', 'y_mirror', 'threshold', 'filter_area')))])
+
+
+class PipelineGrid:
+    """Runs the projection pipeline (load, resize, orient, threshold, filter, project, aggregate) over a grid of
+    brains x thresholds x filter areas x y_mirror x normalizations, computing every intermediate result once.
+
+    Each stage's result is cached keyed by the grid parameters it depends on (see STAGES) and reused by every
+    combination that shares them. The grid is walked brain by brain so that the filter areas of each threshold are
+    projected together with a single sparse indicator x weights x nodes product, and a brain's cached results are
+    dropped once it is done.
+
+    Attributes
+    ----------
+    pp : ProjPredictor
+        The predictor with the voxel array to project through. Its stored image and projections are left as they
+        are.
+    brains : Dict[str, Tuple[str, str]]
+        The image file and source area of each brain
+    areas : List[str]
+        The target areas to aggregate the projections over
+    reshape : bool
+        Whether images are resized to the predictor's default shape before being oriented
+    stage_stats : dict
+        For each stage, the number of times it was computed, the number of times a cached result was reused, and
+        the total seconds spent computing it
+    """
+    def __init__(self,
+                 pp: ProjPredictor,
+                 brains: Dict[str, Tuple[str, str]],
+                 areas: List[str],
+                 reshape: bool = True) -> None:
+        """
+
+        Parameters
+        ----------
+        pp : ProjPredictor
+            The predictor with the voxel array to project through.
+        brains : Dict[str, Tuple[str, str]]
+            The image file and source area of each brain, keyed by brain name.
+        areas : List[str]
+            The target areas to aggregate the projections over.
+        reshape : bool
+            Whether to resize the images to the predictor's default shape before orienting them.
+        """
+        self.pp = pp
+        self.brains = brains
+        self.areas = areas
+        self.reshape = reshape
+        self.stage_stats = {stage: {'computed': 0, 'reused': 0, 'seconds': 0.0} for stage in STAGES}
+        self._results = {}
+        self._aggregation, self._volumes = pp.region_aggregation_matrix(pp.struct_names_to_ids(areas))
+
+    def run(self,
+            thresholds: List[float],
+            filter_areas: List[Union[str, List[str]]],
+            y_mirrors: List[bool] = (False,),
+            normalizations: List[Tuple[bool, bool]] = tuple(NORMALIZATION_COLUMNS)) -> pd.DataFrame:
+        """Computes the projection strengths of every combination of the grid.
+
+        Parameters
+        ----------
+        thresholds : List[float]
+            The thresholds. Voxels above a threshold are selected.
+        filter_areas : List[Union[str, List[str]]]
+            The filter areas, each a structure name, a list of structure names (which will be unioned together),
+            or None for no filter.
+        y_mirrors : List[bool]
+            Whether to mirror the images along the median plane.
+        normalizations : List[Tuple[bool, bool]]
+            The (normalize_source, normalize_target) variants to output.
+
+        Returns
+        -------
+        A long form DataFrame with a row per brain, y_mirror, threshold, filter area, normalization and target
+        area, with the source and target voxel counts and the projection strength.
+        """
+        filter_keys = [tuple(area) if isinstance(area, list) else area for area in filter_areas]
+        tables = []
+        for brain in self.brains:
+            for y_mirror, thresh in itertools.product(y_mirrors, thresholds):
+                grid_params = [{'brain': brain, 'y_mirror': y_mirror, 'threshold': thresh, 'filter_area': key}
+                               for key in filter_keys]
+                self._project_together(grid_params)
+                for params in grid_params:
+                    table = self._get('aggregate', params)
+                    for normalization in normalizations:
+                        rows = table[['Source area', 'Target area', 'Source voxels', 'Target voxels']].copy()
+                        rows['Projection strength'] = table[NORMALIZATION_COLUMNS[normalization]]
+                        rows['Normalization'] = NORMALIZATION_NAMES[normalization]
+                        rows['Brain'] = brain
+                        rows['Y mirror'] = y_mirror
+                        rows['Threshold'] = thresh
+                        rows['Filter area'] = self._filter_label(params['filter_area'])
+                        tables.append(rows)
+            self._drop_brain(brain)
+        if not tables:
+            return pd.DataFrame()
+        return pd.concat(tables, ignore_index=True)
+
+    def report(self) -> str:
+        """Summarizes how many times each stage was computed and reused, and the time spent computing it."""
+        lines = []
+        for stage, stats in self.stage_stats.items():
+            lines.append(f'{stage:>9}: computed {stats["computed"]}, reused {stats["reused"]}, '
+                         f'{stats["seconds"]:.2f} s')
+        return '\n'.join(lines)
+
+    def _get(self, stage: str, params: Dict[str, Any]) -> Any:
+        """Returns the result of a stage for the given grid parameters, computing it (and the stages it depends on)
+        only if it isn't cached."""
+        key = self._key(stage, params)
+        if key in self._results:
+            self.stage_stats[stage]['reused'] += 1
+            return self._results[key]
+        if stage == 'project':
+            # Projections are only made by _project_together, which batches the filter areas of a threshold
+            self._project_together([params])
+            return self._results[key]
+        parent = STAGES[stage][0]
+        inputs = self._get(parent, params) if parent is not None else None
+        start = time.perf_counter()
+        result = getattr(self, f'_{stage}')(inputs, params)
+        self._record(stage, start)
+        self._results[key] = result
+        if stage == 'aggregate':
+            # The target mask space projections are much larger than their table and nothing else reads them
+            self._results.pop(self._key(parent, params), None)
+        return result
+
+    @staticmethod
+    def _key(stage: str, params: Dict[str, Any]) -> tuple:
+        return (stage,) + tuple(params[dependency] for dependency in STAGES[stage][1])
+
+    def _project_together(self, grid_params: List[Dict[str, Any]]) -> None:
+        """Projects the filter stage results of several grid points that aren't projected yet in one product and
+        caches them as their project stage results. Grid points already aggregated are skipped, as their
+        projections have been dropped."""
+        pending = [params for params in grid_params
+                   if self._key('project', params) not in self._results
+                   and self._key('aggregate', params) not in self._results]
+        if not pending:
+            return
+        filtered = [self._get('filter', params) for params in pending]
+        start = time.perf_counter()
+        rows = self.pp.project_selections([selected for selected, _, _ in filtered],
+                                          [values for _, values, _ in filtered])
+        self._record('project', start, len(pending))
+        for params, row, (_, _, source_voxels) in zip(pending, rows, filtered):
+            self._results[self._key('project', params)] = (row, source_voxels)
+
+    def _load(self, _, params: Dict[str, Any]) -> np.array:
+        from skimage import io
+        return io.imread(self.brains[params['brain']][0])
+
+    def _resize(self, image: np.array, params: Dict[str, Any]) -> np.array:
+        if not self.reshape:
+            return image
+        from skimage.transform import resize
+        return resize(image, self.pp.default_shape)
+
+    def _orient(self, image: np.array, params: Dict[str, Any]) -> np.array:
+        return ProjPredictor.orient_image(image, params['y_mirror'])
+
+    def _threshold(self, image: np.array, params: Dict[str, Any]) -> Tuple[np.array, np.array]:
+        """The source mask voxels above the threshold, and the oriented image to count the source voxels in."""
+        return self.pp.mask_source(image) > params['threshold'], image
+
+    def _filter(self,
+                thresholded: Tuple[np.array, np.array],
+                params: Dict[str, Any]) -> Tuple[np.array, np.array, int]:
+        """The selected source voxels, their weights and the number of source voxels, as select_source finds
+        them."""
+        keep, image = thresholded
+        return self.pp.filtered_selection(keep, params['threshold'], self._filter_names(params['filter_area']),
+                                          image)
+
+    def _aggregate(self, projected: Tuple[np.array, int], params: Dict[str, Any]) -> pd.DataFrame:
+        """The proj_by_area table of the projections, with every normalization as a column."""
+        row, source_voxels = projected
+        return proj_by_area_frame(self.brains[params['brain']][1], self.areas, source_voxels, self._volumes,
+                                  self._aggregation @ row, self._filter_names(params['filter_area']))
+
+    def _drop_brain(self, brain: str) -> None:
+        # Every stage depends on the brain, so nothing cached for a finished brain will be used again
+        self._results = {key: result for key, result in self._results.items() if key[1] != brain}
+
+    def _record(self, stage: str, start: float, count: int = 1) -> None:
+        self.stage_stats[stage]['computed'] += count
+        self.stage_stats[stage]['seconds'] += time.perf_counter() - start
+
+    @staticmethod
+    def _filter_names(filter_area: Union[str, Tuple[str]]) -> Union[str, List[str]]:
+        # Filter areas are cached as tuples, but ProjPredictor takes lists of names
+        return list(filter_area) if isinstance(filter_area, tuple) else filter_area
+
+    @staticmethod
+    def _filter_label(filter_area: Union[str, Tuple[str]]) -> str:
+        return ', '.join(filter_area) if isinstance(filter_area, tuple) else str(filter_area)
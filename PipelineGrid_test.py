@@ -0,0 +1,98 @@
+import numpy as np
+import os
+import pandas as pd
+import pytest
+from skimage import io
+from PipelineGrid import PipelineGrid
+from ProjPredictor import ProjPredictor, NORMALIZATION_COLUMNS
+from ProjDataset import NORMALIZATION_NAMES
+from SyntheticCache import SyntheticVoxelModelCache
+
+AREAS = ['Somatomotor areas', 'Thalamus', 'Cerebellar nuclei']
+# Resizing smooths the random images towards 0.5
+THRESHOLDS = [0.6, 0.7]
+FILTER_AREAS = ['Cerebellar nuclei', ['Dentate nucleus', 'Interposed nucleus'], None]
+Y_MIRRORS = [False, True]
+
+
+@pytest.fixture(scope='module')
+def cache() -> SyntheticVoxelModelCache:
+    return SyntheticVoxelModelCache(seed=0)
+
+
+@pytest.fixture(scope='module')
+def brains(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('brains')
+    rng = np.random.default_rng(0)
+    brains = {}
+    for brain, source_area in (('DN001', 'Dentate nucleus'), ('IN001', 'Interposed nucleus')):
+        brains[brain] = (os.path.join(directory, f'{brain}.tif'), source_area)
+        io.imsave(brains[brain][0], rng.random((60, 80, 80), dtype=np.float32), check_contrast=False)
+    return brains
+
+
+@pytest.fixture(scope='module')
+def grid_run(cache, brains):
+    grid = PipelineGrid(ProjPredictor(cache=cache), brains, AREAS)
+    return grid, grid.run(THRESHOLDS, FILTER_AREAS, Y_MIRRORS)
+
+
+def test_matches_the_step_by_step_pipeline(cache, brains, grid_run):
+    _, df = grid_run
+    assert len(df) == len(brains) * len(Y_MIRRORS) * len(THRESHOLDS) * len(FILTER_AREAS) * 4 * len(AREAS)
+    pp = ProjPredictor(cache=cache)
+    for brain, (image_file, source_area) in brains.items():
+        for y_mirror in Y_MIRRORS:
+            for thresh in THRESHOLDS:
+                for filter_area in FILTER_AREAS:
+                    pp.set_image_from_file(image_file, y_mirror=y_mirror, source_area=source_area, reshape=True)
+                    pp.threshold(thresh)
+                    if filter_area is not None:
+                        pp.filter_by_name(filter_area)
+                    pp.vol_to_probs()
+                    expected = pp.proj_by_area(AREAS)
+                    label = ', '.join(filter_area) if isinstance(filter_area, list) else str(filter_area)
+                    rows = df[(df['Brain'] == brain) & (df['Y mirror'] == y_mirror) & (df['Threshold'] == thresh)
+                              & (df['Filter area'] == label)]
+                    for normalization, column in NORMALIZATION_COLUMNS.items():
+                        variant = rows[rows['Normalization'] == NORMALIZATION_NAMES[normalization]]
+                        assert list(variant['Source area']) == [source_area] * len(AREAS)
+                        assert list(variant['Target area']) == AREAS
+                        assert (variant['Source voxels'] == pp.source_voxels).all()
+                        np.testing.assert_allclose(variant['Projection strength'], expected[column], rtol=1e-10)
+
+
+def test_computes_each_stage_once_and_drops_finished_brains(brains, grid_run):
+    grid, _ = grid_run
+    n_brains = len(brains)
+    stats = {stage: stage_stats['computed'] for stage, stage_stats in grid.stage_stats.items()}
+    assert stats == {'load': n_brains,
+                     'resize': n_brains,
+                     'orient': n_brains * len(Y_MIRRORS),
+                     'threshold': n_brains * len(Y_MIRRORS) * len(THRESHOLDS),
+                     'filter': n_brains * len(Y_MIRRORS) * len(THRESHOLDS) * len(FILTER_AREAS),
+                     'project': n_brains * len(Y_MIRRORS) * len(THRESHOLDS) * len(FILTER_AREAS),
+                     'aggregate': n_brains * len(Y_MIRRORS) * len(THRESHOLDS) * len(FILTER_AREAS)}
+    # Each filter area's threshold and each threshold's orientation come from the cache
+    assert grid.stage_stats['threshold']['reused'] == stats['filter'] - stats['threshold']
+    assert grid._results == {}
+
+
+def test_project_stage_on_its_own(cache, brains):
+    grid = PipelineGrid(ProjPredictor(cache=cache), brains, AREAS)
+    params = {'brain': 'DN001', 'y_mirror': True, 'threshold': 0.7, 'filter_area': 'Cerebellar nuclei'}
+    row, source_voxels = grid._get('project', params)
+    pp = ProjPredictor(cache=cache)
+    pp.set_image_from_file(brains['DN001'][0], y_mirror=True, reshape=True)
+    pp.select_source(0.7, 'Cerebellar nuclei')
+    pp.vol_to_probs()
+    np.testing.assert_allclose(row, pp.masked_projections, rtol=1e-10)
+    assert source_voxels == pp.source_voxels
+    # Once aggregated, the projections are dropped and only the table is kept
+    grid._get('aggregate', params)
+    assert [key[0] for key in grid._results if key[0] in ('project', 'aggregate')] == ['aggregate']
+
+
+def test_empty_grid(cache, brains):
+    assert PipelineGrid(ProjPredictor(cache=cache), {}, AREAS).run(THRESHOLDS, FILTER_AREAS).empty
+    assert isinstance(PipelineGrid(ProjPredictor(cache=cache), brains, AREAS).run([], FILTER_AREAS), pd.DataFrame)
@@ -0,0 +1,89 @@
+import pandas as pd
+from typing import List, Tuple
+
+# The columns the dataset is partitioned (and so can be filtered cheaply) by
+PARTITION_COLUMNS = ['Source area', 'Filter area', 'Normalization']
+CATEGORICAL_COLUMNS = ['Brain', 'Source area', 'Target area', 'Filter area', 'Normalization']
+# The name of each (normalize_source, normalize_target) variant, as used in the BatchProjPred file names
+NORMALIZATION_NAMES = {(False, False): 'no-norm',
+                       (True, False): 'source-norm',
+                       (False, True): 'target-norm',
+                       (True, True): 'both-norm'}
+
+
+def to_dataset_rows(df: pd.DataFrame, brain: str = None) -> pd.DataFrame:
+    """Turns a long form proj_by_area DataFrame (see variants_to_long) into rows of the dataset, with a
+    Normalization column, a Brain column, and categorical identifying columns.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        A long form proj_by_area DataFrame.
+    brain : str
+        The brain the projections came from, if any.
+
+    Returns
+    -------
+    The dataset rows.
+    """
+    df = df.copy()
+    df['Brain'] = brain
+    df['Normalization'] = [NORMALIZATION_NAMES[(source, target)]
+                           for source, target in zip(df['Normalized by source'], df['Normalized by target'])]
+    if 'Filter area' not in df.columns:
+        df['Filter area'] = 'None'
+    # Partition values have to be strings, so a list of filter areas becomes a single string
+    df['Filter area'] = [', '.join(area) if isinstance(area, list) else str(area) for area in df['Filter area']]
+    for column in CATEGORICAL_COLUMNS:
+        df[column] = df[column].astype('category')
+    return df
+
+
+def append_to_dataset(df: pd.DataFrame, root: str, basename: str = None) -> None:
+    """Appends dataset rows as new Parquet files in the partitioned dataset at root.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Rows as returned by to_dataset_rows.
+    root : str
+        The root directory of the dataset. It is created if it does not exist.
+    basename : str
+        If given, the files are named after it (e.g. the brain), so that appending the same rows again (e.g. when
+        a batch is rerun after crashing before recording them as done) overwrites them instead of duplicating
+        them. It must be unique among the writers of each partition.
+
+    Returns
+    -------
+    None
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if basename is None:
+        # Every call writes files with new unique names, so concurrent writers never clobber each other
+        pq.write_to_dataset(table, root, partition_cols=PARTITION_COLUMNS)
+    else:
+        pq.write_to_dataset(table, root, partition_cols=PARTITION_COLUMNS,
+                            basename_template=f'{basename}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore')
+
+
+def load_dataset(root: str, filters: List[Tuple] = None, columns: List[str] = None) -> pd.DataFrame:
+    """Reads (a slice of) the dataset at root in one go.
+
+    Parameters
+    ----------
+    root : str
+        The root directory of the dataset.
+    filters : List[Tuple]
+        pyarrow filters, e.g. [('Normalization', '==', 'source-norm'), ('Filter area', '==', 'Thalamus')].
+        Filters on the partition columns skip whole directories without reading them.
+    columns : List[str]
+        The columns to read. All of them by default.
+
+    Returns
+    -------
+    The rows of the dataset that pass the filters.
+    """
+    return pd.read_parquet(root, engine='pyarrow', filters=filters, columns=columns)
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+import ProjDataset
+from ProjPredictor import ProjPredictor
+from SyntheticCache import SyntheticVoxelModelCache
+
+AREAS = ['Somatomotor areas', 'Thalamus', 'Cerebellar nuclei']
+
+
+@pytest.fixture(scope='module')
+def predictor() -> ProjPredictor:
+    pp = ProjPredictor(cache=SyntheticVoxelModelCache(seed=0), source_area='Dentate nucleus')
+    pp.set_raw_image(np.random.default_rng(0).random((65, 88, 88)))
+    pp.select_source(0.98, 'Cerebellar nuclei')
+    pp.vol_to_probs()
+    return pp
+
+
+def test_appending_the_same_brain_again_overwrites_it(predictor, tmp_path):
+    root = str(tmp_path)
+    for _ in range(2):
+        predictor.append_proj_by_area_dataset(AREAS, root, brain='DN001')
+    predictor.append_proj_by_area_dataset(AREAS, root, brain='DN002')
+    df = ProjDataset.load_dataset(root)
+    assert len(df) == 2 * 4 * len(AREAS)
+    assert sorted(df.groupby('Brain', observed=True).size().items()) == [('DN001', 4 * len(AREAS)),
+                                                                        ('DN002', 4 * len(AREAS))]
+
+
+def test_appending_without_a_basename_adds_rows(tmp_path):
+    rows = ProjDataset.to_dataset_rows(pd.DataFrame({'Source area': ['Dentate nucleus'],
+                                                     'Target area': ['Thalamus'],
+                                                     'Projection strength': [1.0],
+                                                     'Normalized by source': [False],
+                                                     'Normalized by target': [False]}), 'DN001')
+    for _ in range(2):
+        ProjDataset.append_to_dataset(rows, str(tmp_path))
+    assert len(ProjDataset.load_dataset(str(tmp_path))) == 2
+
+
+def test_load_dataset_filters_on_partition_columns(predictor, tmp_path):
+    root = str(tmp_path)
+    predictor.append_proj_by_area_dataset(AREAS, root, brain='DN001')
+    expected = predictor.proj_by_area(AREAS)
+    df = ProjDataset.load_dataset(root, filters=[('Normalization', '==', 'source-norm'),
+                                                 ('Filter area', '==', 'Cerebellar nuclei')])
+    assert len(df) == len(AREAS)
+    assert set(df['Normalization']) == {'source-norm'}
+    assert set(df['Source area']) == {'Dentate nucleus'}
+    df = df.set_index(df['Target area'].astype(str)).loc[AREAS]
+    np.testing.assert_allclose(df['Projection strength'], expected['Projection strength (source-norm)'])
+    assert ProjDataset.load_dataset(root, filters=[('Filter area', '==', 'Thalamus')]).empty
+    columns = ProjDataset.load_dataset(root, filters=[('Normalization', 'in', ['no-norm', 'both-norm'])],
+                                       columns=['Brain', 'Projection strength', 'Normalization'])
+    assert list(columns.columns) == ['Brain', 'Projection strength', 'Normalization']
+    assert len(columns) == 2 * len(AREAS)
@@ -1,12 +1,76 @@
-from mcmodels.core import VoxelModelCache
-from allensdk.api.queries.mouse_connectivity_api import MouseConnectivityApi
 import numpy as np
-from typing import Union, List
-from skimage import io
-from skimage.transform import resize
-import napari
+from typing import Union, List, Tuple, TYPE_CHECKING
 import pandas as pd
+from scipy import sparse
 import warnings
+from collections import OrderedDict
+from functools import lru_cache
+import VoxelSnapshot
+import ProjDataset
+from RegionModel import RegionModel
+from StructureIndex import StructureIndex
+from ResultCache import ResultCache
+from Instrumentation import Instrumentation, instrumented, span
+
+# mcmodels/allensdk, skimage and napari are slow to import and not needed by every process (e.g. batch workers
+# never view anything, and nothing needs the cache with load_cache=False), so they are imported on first use.
+if TYPE_CHECKING:
+    import napari
+
+# The proj_by_area column holding each (normalize_source, normalize_target) variant of the projection strengths
+NORMALIZATION_COLUMNS = {(False, False): 'Projection strength',
+                         (True, False): 'Projection strength (source-norm)',
+                         (False, True): 'Projection strength (target-norm)',
+                         (True, True): 'Projection strength (both-norm)'}
+
+# The shape of the 100um annotation volume that source images are oriented into
+ANNOTATION_SHAPE = (132, 80, 114)
+# Where the (transposed) image sits along each axis of the annotation: flush with the start, with a given number of
+# voxels of padding after it, or centred. The padding itself follows from the image and annotation shapes.
+IMAGE_PLACEMENT = ('start', 10, 'centre')
+# The number of times in a row the summed weight rows of the source voxels are updated with just the changed voxels
+# before they are summed again from scratch, which keeps the floating point error of the updates from building up
+INCREMENTAL_REFRESH = 64
+
+
+@lru_cache(maxsize=8)
+def orientation_map(image_shape: Tuple[int, int, int], y_mirror: bool = False) -> Tuple[np.array, np.array]:
+    """Precomputes where each voxel of an image of the given shape ends up when it is permuted, padded, and
+    reflected into the annotation, so that orienting an image is a single gather.
+
+    Parameters
+    ----------
+    image_shape : Tuple[int, int, int]
+        The shape of the images, in the orientation they were acquired in.
+    y_mirror : bool
+        Whether the images are mirrored along the median plane.
+
+    Returns
+    -------
+    The flat annotation indices that come from the image and the flat image index each of them comes from.
+    """
+    transposed_shape = (image_shape[1], image_shape[0], image_shape[2])
+    pads = []
+    for size, annotation_size, placement in zip(transposed_shape, ANNOTATION_SHAPE, IMAGE_PLACEMENT):
+        extra = annotation_size - size
+        if placement == 'start':
+            before = 0
+        elif placement == 'centre':
+            before = extra // 2
+        else:
+            before = extra - placement
+        pads.append((before, extra - before))
+    # Orient the flat index of every image voxel, with -1 for padding, the same way the image would be
+    index = np.transpose(np.arange(np.prod(image_shape)).reshape(image_shape), (1, 0, 2))
+    index = np.flip(np.pad(index, pads, 'constant', constant_values=-1), axis=(0, 1))
+    if y_mirror:
+        index = np.fliplr(index)
+    index = index.ravel()
+    annotation_indices = np.flatnonzero(index >= 0)
+    image_indices = index[annotation_indices]
+    annotation_indices.setflags(write=False)
+    image_indices.setflags(write=False)
+    return annotation_indices, image_indices
 
 
 class ProjPredictor:
@@ -30,6 +94,23 @@ class ProjPredictor:
         A boolean representing whether the image should be mirrored along the median plane
     verbose : bool
         A boolean representing whether verbose debugging messages should be printed
+    snapshot_dir : str
+        A directory with a memory mapped snapshot of the voxel array (see save_snapshot), if one was used
+    mask_cache_size : int
+        The maximum number of structure masks kept in the least recently used structure mask cache
+    region_model : RegionModel
+        A reduced model with the nodes summed over target structures, used for per-area projection strengths
+        when no projections have been computed or set
+    instrumentation : Instrumentation
+        If set, records the wall time, CPU time and memory of each method call (see Instrumentation)
+    dtype : np.dtype
+        The floating point type the weights, nodes, source weights and projections are kept and computed in
+    result_cache : ResultCache
+        If set, projections are looked up in and stored to this on-disk cache, keyed by the selected source
+        voxels, their weights, and the model_version
+    incremental : bool
+        Whether vol_to_probs updates the summed weight rows of the previous call with just the source voxels that
+        changed (see _weight_sum) instead of summing them from scratch every time
 
     Methods
     -------
@@ -38,12 +119,20 @@ class ProjPredictor:
     def __init__(self,
                  load_cache: bool = True,
                  manifest_file: str = 'voxel_model_manifest.json',
-                 ccf_version: str = MouseConnectivityApi.CCF_VERSION_DEFAULT,
+                 ccf_version: str = None,
                  image_file: str = None,
                  source_area: str = None,
                  filter_area: Union[str, List[str]] = None,
                  y_mirror: bool = False,
-                 verbose: bool = False) -> None:
+                 verbose: bool = False,
+                 snapshot_dir: str = None,
+                 mask_cache_size: int = 128,
+                 region_model_file: str = None,
+                 cache=None,
+                 instrumentation: Instrumentation = None,
+                 dtype: Union[str, np.dtype] = None,
+                 result_cache: ResultCache = None,
+                 incremental: bool = True) -> None:
         """
 
         Parameters
@@ -54,7 +143,8 @@ class ProjPredictor:
         manifest_file : str
             A string representing the manifest to read from for the voxel model cache
         ccf_version : str
-            A formatted string representing the version of allensdk data to use
+            A formatted string representing the version of allensdk data to use. Defaults to
+            MouseConnectivityApi.CCF_VERSION_DEFAULT.
         image_file : str
             A filename pointing to an image to read in
         source_area : str
@@ -65,23 +155,88 @@ class ProjPredictor:
             A boolean representing whether the image should be mirrored along the median plane
         verbose : bool
             A boolean representing whether verbose debugging messages should be printed
+        snapshot_dir : str
+            A directory written by save_snapshot. If given, the voxel array and masks are memory mapped from it
+            instead of being rebuilt from the voxel model cache.
+        mask_cache_size : int
+            The maximum number of structure masks (and their voxel counts) to keep cached, keyed by structure
+            id(s). The least recently used mask is dropped first.
+        region_model_file : str
+            A file written by save_region_model to load as the region model.
+        cache : VoxelModelCache
+            An already constructed voxel model cache to use instead of loading one from manifest_file, e.g. a
+            SyntheticVoxelModelCache to run without downloaded data. It is used even if load_cache is False.
+        instrumentation : Instrumentation
+            Records the wall time, CPU time and memory of each method call, e.g. to find where a batch's time goes.
+        dtype : Union[str, np.dtype]
+            The floating point type to compute the projections in, e.g. 'float32' to halve the memory of the
+            weights, nodes and projections and speed up the products (see precision_error for the error this
+            causes). The voxel array is converted once when it is loaded; a snapshot saved in float32 is memory
+            mapped without a copy. Defaults to the dtype of the voxel array.
+        result_cache : ResultCache
+            An on-disk cache of projections to share computed projections between runs and processes, e.g. between
+            the notebook and the batch scripts.
+        incremental : bool
+            Whether to update the summed weight rows of the previous projection with just the source voxels that
+            changed, e.g. when nudging the threshold. Turn it off to time or check the projections summed from
+            scratch.
         """
         self.y_mirror = y_mirror
         self.verbose = verbose
-        if load_cache:
-            if self.verbose:
-                print('Loading Voxel Model Cache...')
-            self._cache = VoxelModelCache(manifest_file=manifest_file, ccf_version=ccf_version)
-            if self.verbose:
-                print('Extracting voxel array, source mask, and target mask...')
-            self._voxel_array, self._source_mask, self._target_mask = self._cache.get_voxel_connectivity_array()
+        self.instrumentation = instrumentation
+        self.result_cache = result_cache
+        self.incremental = incremental
+        self._model_version: str = None
+        self.snapshot_dir = snapshot_dir
+        self.mask_cache_size = mask_cache_size
+        self._mask_cache = OrderedDict()
+        if load_cache or cache is not None:
+            if cache is not None:
+                self._cache = cache
+            else:
+                if self.verbose:
+                    print('Loading Voxel Model Cache...')
+                from mcmodels.core import VoxelModelCache
+                if ccf_version is None:
+                    from allensdk.api.queries.mouse_connectivity_api import MouseConnectivityApi
+                    ccf_version = MouseConnectivityApi.CCF_VERSION_DEFAULT
+                self._cache = VoxelModelCache(manifest_file=manifest_file, ccf_version=ccf_version)
+            if snapshot_dir is not None:
+                if self.verbose:
+                    print(f'Memory mapping voxel array, source mask, and target mask from "{snapshot_dir}"...')
+                self._voxel_array, self._source_mask, self._target_mask = VoxelSnapshot.load_snapshot(snapshot_dir)
+            else:
+                if self.verbose:
+                    print('Extracting voxel array, source mask, and target mask...')
+                self._voxel_array, self._source_mask, self._target_mask = \
+                    self._cache.get_voxel_connectivity_array()
+            if dtype is not None:
+                self._convert_voxel_array(np.dtype(dtype))
+        self._raw_image: np.array = None
+        self._masked_image: np.array = None
+        self._raw_area_maps = {}
         if image_file is not None:
             if self.verbose:
                 print(f'Loading image "{image_file}"...')
+            from skimage import io
             self.image: np.array = io.imread(image_file)
         else:
             self._image: np.array = None
         self._projections: np.array = None
+        self._masked_projections: np.array = None
+        self._aggregation_cache = {}
+        self._source_orientation_maps = {}
+        self._compiled_filters = {}
+        self._structure_index: StructureIndex = None
+        self._selection = None
+        self._filter_results = {}
+        self._weight_sum_state = None
+        if region_model_file is not None:
+            if self.verbose:
+                print(f'Loading region model "{region_model_file}"...')
+            self.region_model = RegionModel.load(region_model_file)
+        else:
+            self.region_model: RegionModel = None
         if source_area is not None:
             self.source_area: str = source_area
         if filter_area is not None:
@@ -90,6 +245,46 @@ class ProjPredictor:
             self._filter_area = None
         self.default_shape = (65, 88, 88)
 
+    @property
+    def dtype(self) -> np.dtype:
+        return self._voxel_array.weights.dtype
+
+    @property
+    def model_version(self) -> str:
+        """A hash identifying the voxel array: the model_digest of all of its weights and nodes, and the dtype the
+        projections are computed in.
+
+        A snapshot stores the digest of its weights and nodes when it is saved, so it is only read back. Otherwise
+        (or for a snapshot saved without one) the weights and nodes are hashed in full the first time this is
+        asked for, once per ProjPredictor, so ask for it before forking workers that share the predictor and use a
+        snapshot to avoid hashing them again in every session.
+        """
+        if self._model_version is None:
+            digest = VoxelSnapshot.load_digest(self.snapshot_dir) if self.snapshot_dir is not None else None
+            if digest is None:
+                if self.verbose:
+                    print('Hashing voxel array...')
+                digest = VoxelSnapshot.model_digest(self._voxel_array.weights, self._voxel_array.nodes)
+            self._model_version = ResultCache.key(digest, self.dtype.str)
+        return self._model_version
+
+    def _convert_voxel_array(self, dtype: np.dtype) -> None:
+        """Converts the weights and nodes to the given dtype, if they aren't in it already.
+
+        The masks are swapped for IndexMasks, which map projections back to the annotation in their own dtype
+        rather than in float64.
+        """
+        weights, nodes = self._voxel_array.weights, self._voxel_array.nodes
+        if weights.dtype != dtype or nodes.dtype != dtype:
+            if self.verbose:
+                print(f'Converting voxel array to {dtype}...')
+            self._voxel_array = type(self._voxel_array)(np.asarray(weights, dtype=dtype),
+                                                        np.asarray(nodes, dtype=dtype))
+        if not isinstance(self._source_mask, VoxelSnapshot.IndexMask):
+            self._source_mask = VoxelSnapshot.IndexMask.from_mask(self._source_mask)
+        if not isinstance(self._target_mask, VoxelSnapshot.IndexMask):
+            self._target_mask = VoxelSnapshot.IndexMask.from_mask(self._target_mask)
+
     @property
     def source_area(self) -> str:
         return self._source_area
@@ -108,26 +303,45 @@ class ProjPredictor:
         self.assert_valid_structure_name(struct_name)
         self._filter_area = struct_name
 
+    @property
+    def structure_index(self) -> StructureIndex:
+        """The index of the structure tree shared by all structure lookups, built on first use."""
+        if self._structure_index is None:
+            self._structure_index = StructureIndex(self._cache.get_structure_tree())
+        return self._structure_index
+
     def assert_valid_structure_name(self, struct_name: Union[str, List[str]]):
         if not isinstance(struct_name, list):
             struct_name = [struct_name]
         if not np.array([isinstance(name, str) for name in struct_name]).all():
-            warnings.warn('Source area must be a string of the FULL name (not acronym) of the source area.',
+            warnings.warn('Source area must be a string of the full name or the acronym of the source area.',
                           UserWarning)
-        names = self._cache.get_structure_tree().get_name_map().values()
-        if np.array([name not in names for name in struct_name]).any():
-            warnings.warn('Source area name (not acronym) cannot be found in the structure tree.', UserWarning)
+        if np.array([name not in self.structure_index for name in struct_name]).any():
+            warnings.warn('Source area name or acronym cannot be found in the structure tree.', UserWarning)
 
     @property
     def image(self) -> np.array:
+        """The oriented source image. An image set with set_raw_image is only oriented once it is asked for."""
+        if self._image is None and self._raw_image is not None:
+            self._image = self.orient_image(self._raw_image, self.y_mirror)
         return self._image
 
+    def _image_changed(self) -> None:
+        """Drops everything derived from the stored image, before a new one is stored."""
+        self._selection = None
+        self._filter_results = {}
+        self._raw_image = None
+        self._masked_image = None
+
     @image.setter
     def image(self, image_file: Union[str, np.array]) -> None:
         if isinstance(image_file, str):
+            from skimage import io
+            self.reset_incremental()
             self._image = io.imread(image_file)
         else:
             self._image = image_file
+        self._image_changed()
         self._permute_pad_reflect()
 
     @property
@@ -139,10 +353,20 @@ class ProjPredictor:
     @projections.setter
     def projections(self, image_file: Union[str, np.array]) -> None:
         if isinstance(image_file, str):
+            from skimage import io
             self._projections = io.imread(image_file)
         else:
             self._projections = image_file
+        self._masked_projections = None
+
+    @property
+    def masked_projections(self) -> np.array:
+        """The projections as a vector over the voxels of the target mask."""
+        if self._masked_projections is None:
+            self._masked_projections = self._target_mask.mask_volume(self.projections)
+        return self._masked_projections
 
+    @instrumented
     def save_projections(self, filename: str, bits: int = 32) -> None:
         """Saves the projections with the given filename
 
@@ -166,56 +390,328 @@ class ProjPredictor:
             float_type = np.float64
         else:
             float_type = np.float32
+        from skimage import io
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', UserWarning)
             io.imsave(filename, self.projections.astype(float_type))
 
+    @instrumented
+    def save_snapshot(self, directory: str, dtype: Union[str, np.dtype] = None) -> None:
+        """Exports the voxel array and the source and target masks to .npy files in the given directory.
+
+        This only needs to be done once. Passing the directory as snapshot_dir to later ProjPredictors
+        memory maps the arrays instead of rebuilding them from the voxel model cache.
+
+        Parameters
+        ----------
+        directory : str
+            The directory to write the snapshot to.
+        dtype : Union[str, np.dtype]
+            The floating point type to save the weights and nodes as. Defaults to the predictor's dtype.
+
+        Returns
+        -------
+        None
+        """
+        if self.verbose:
+            print(f'Saving voxel array snapshot to: {directory}')
+        VoxelSnapshot.save_snapshot(directory, self._voxel_array, self._source_mask, self._target_mask, dtype=dtype)
+
+    @instrumented
     def set_image_from_file(self, image_file: str,
                             y_mirror: bool = False,
                             source_area: str = None,
                             reshape: bool = False) -> None:
-        self.y_mirror = y_mirror
         if self.verbose:
             print(f'Loading image "{image_file}"')
+        # An image from another file is a new brain rather than an edit of the last one
+        self.reset_incremental()
+        self.set_raw_image(self.read_image(image_file, reshape=reshape, orient=False),
+                           y_mirror=y_mirror,
+                           source_area=source_area)
+
+    @instrumented
+    def read_image(self, image_file: str, y_mirror: bool = False, reshape: bool = False,
+                   orient: bool = True) -> np.array:
+        """Reads an image file, optionally resizes it to the default shape, and orients it (see orient_image).
+
+        Nothing is stored on the predictor, so this is safe to call from other threads while the predictor
+        is busy, e.g. to prefetch images (see ImagePrefetcher).
+
+        Parameters
+        ----------
+        image_file : str
+            A filename pointing to an image to read in.
+        y_mirror : bool
+            Whether the image should be mirrored along the median plane.
+        reshape : bool
+            Whether to resize the image to default_shape before orienting it.
+        orient : bool
+            Whether to orient the image. If not, it is ready for set_raw_image instead.
+
+        Returns
+        -------
+        The oriented image, ready for set_oriented_image.
+        """
+        from skimage import io
         im = io.imread(image_file)
         if reshape:
+            from skimage.transform import resize
             im = resize(im, self.default_shape)
-        self.image = im
+        return self.orient_image(im, y_mirror) if orient else im
+
+    def set_raw_image(self, image: np.array, y_mirror: bool = False, source_area: str = None) -> None:
+        """Stores an image in the orientation it was acquired in, mapping it straight to the source mask vector
+        with a single gather (see mask_raw_image).
+
+        select_source, vol_to_probs, vol_to_probs_by_filter and threshold_sweep work from the source mask vector
+        and the image itself, so the oriented volume is only built if something asks for the image (e.g.
+        threshold, filter_by_name or view_source).
+
+        Parameters
+        ----------
+        image : np.array
+            The image, in the orientation it was acquired in (resized to default_shape if need be).
+        y_mirror : bool
+            Whether the image should be mirrored along the median plane.
+        source_area : str
+            The name of the area from which the image was gathered.
+        """
+        self._image_changed()
+        self.y_mirror = y_mirror
+        self._image = None
+        self._raw_image = image
+        self._masked_image = self.mask_raw_image(image, y_mirror)
         if source_area is not None:
             self.source_area = source_area
 
-    def view_source(self) -> napari.Viewer:
+    def set_oriented_image(self, image: np.array, y_mirror: bool = False, source_area: str = None) -> None:
+        """Stores an image that has already been oriented by orient_image or read_image.
+
+        Parameters
+        ----------
+        image : np.array
+            The oriented image.
+        y_mirror : bool
+            Whether the image was mirrored along the median plane.
+        source_area : str
+            The name of the area from which the image was gathered.
+        """
+        self._image_changed()
+        self.y_mirror = y_mirror
+        self._image = image
+        if source_area is not None:
+            self.source_area = source_area
+
+    def view_source(self) -> 'napari.Viewer':
         """Brings up a napari viewer of the source image.
 
         Returns
         -------
         napari viewer with the source image."""
+        import napari
         with napari.gui_qt():
             return napari.view_image(self.image)
 
-    def view_proj(self) -> napari.Viewer:
+    def view_proj(self) -> 'napari.Viewer':
         """Brings up a napari viewer of the projection image. If there is not one, then
         the projections are calculated.
 
         Returns
         -------
         napari viewer with the projection image."""
+        import napari
         with napari.gui_qt():
             return napari.view_image(self.projections)
 
+    @instrumented
     def threshold(self, thresh: float) -> None:
-        self._image = self.image > thresh
+        image = self.image > thresh
+        self._image_changed()
+        self._image = image
+
+    @instrumented
+    def select_source(self, thresh: float = None, structure_name: Union[str, List[str]] = None) -> None:
+        """Thresholds the stored image, filters it by the given structure(s), and selects the source voxels in one
+        vectorized pass over the source mask vector, using the filter compiled by compile_filter.
+
+        This gives the same projections and source voxel count as threshold, filter_by_name and vol_to_probs
+        in turn, but never builds a full volume. The stored image itself is left as it is: the selection is
+        used by vol_to_probs, region_profile and proj_by_area until a new image is set, thresholded or filtered.
 
-    def vol_to_probs(self, save: bool = True) -> np.array:
+        Parameters
+        ----------
+        thresh : float
+            Voxels above this value are selected. If not given, voxels equal to 1 are selected.
+        structure_name : Union[str, List[str]]
+            A single structure name or list of structure names (which will be unioned together) to filter by.
+        """
+        if self.verbose:
+            print('Selecting source voxels...')
+        if structure_name is not None:
+            self.filter_area = structure_name
+        masked = self._masked_source()
+        keep = masked > thresh if thresh is not None else masked == 1
+        self._selection = self.filtered_selection(keep, thresh, structure_name)
+
+    def filtered_selection(self,
+                           keep: np.array,
+                           thresh: float = None,
+                           structure_name: Union[str, List[str]] = None,
+                           image: np.array = None) -> Tuple[np.array, np.array, int]:
+        """Filters a thresholded source mask vector of the stored image, or of the given oriented image, and
+        counts its source voxels, as select_source does. The stored image and selection are left as they are.
+
+        Parameters
+        ----------
+        keep : np.array
+            Whether each source mask voxel is above the threshold, e.g. mask_source(image) > thresh.
+        thresh : float
+            The threshold keep was made with, to count the source voxels. If not given, voxels equal to 1 are
+            counted.
+        structure_name : Union[str, List[str]]
+            A single structure name or list of structure names (which will be unioned together) to filter by.
+        image : np.array
+            An oriented image to count the source voxels in instead of the stored image.
+
+        Returns
+        -------
+        The selected source voxels, their weights and the number of source voxels, as stored by select_source.
+        """
+        if structure_name is not None:
+            keep = keep & self.compile_filter(structure_name)[0]
+        # Voxels outside of the source mask don't project anywhere, but they count towards the source voxels
+        # used to normalize by source, as they do after threshold and filter_by_name
+        values, padding = self._area_values(structure_name, image)
+        source_voxels = (values > thresh).sum() if thresh is not None else (values == 1).sum()
+        if thresh is not None and thresh < 0:
+            source_voxels += padding
+        selected = np.flatnonzero(keep)
+        return selected, np.ones(len(selected), dtype=self.dtype), source_voxels
+
+    @instrumented
+    def vol_to_probs_by_filter(self,
+                               structure_names: List[Union[str, List[str]]],
+                               thresh: float = None,
+                               save: bool = True) -> dict:
+        """Computes the projections of the stored image filtered by each of several filter areas, e.g. to compare
+        filters without reading every image again.
+
+        The image is thresholded once, and the selection of each filter (as select_source would make it) becomes
+        a row of a sparse indicator matrix, so that all the filters are projected with a single indicator x
+        weights x nodes product. The current selection and projections are left as they are; if saved, any of
+        the filters' can be made the current ones with select_filter.
+
+        Parameters
+        ----------
+        structure_names : List[Union[str, List[str]]]
+            The filter areas, each a structure name, a list of structure names (which will be unioned together),
+            or None for no filter.
+        thresh : float
+            Voxels above this value are selected. If not given, voxels equal to 1 are selected.
+        save : bool
+            Whether to keep the selections and projections for select_filter.
+
+        Returns
+        -------
+        A dictionary from each filter area (with lists of names as tuples, and None for no filter) to its
+        projection image.
+        """
+        if self.verbose:
+            print(f'Converting source image to projection probabilities for {len(structure_names)} filters...')
+        for names in structure_names:
+            if names is not None:
+                self.assert_valid_structure_name(names)
+        masked = self._masked_source()
+        keep = masked > thresh if thresh is not None else masked == 1
+        selections = [self.filtered_selection(keep, thresh, names) for names in structure_names]
+        rows = self.project_selections([selection[0] for selection in selections],
+                                       [selection[1] for selection in selections])
+        keys = [self._filter_key(names) for names in structure_names]
+        projections = {key: self._target_mask.map_masked_to_annotation(row) for key, row in zip(keys, rows)}
+        if save:
+            self._filter_results = {key: (selection, row, projections[key])
+                                    for key, selection, row in zip(keys, selections, rows)}
+        return projections
+
+    def select_filter(self, structure_name: Union[str, List[str]]) -> None:
+        """Makes the selection and projections of one of the filters of the last vol_to_probs_by_filter the
+        current ones, as if select_source and vol_to_probs had been called with that filter.
+
+        Parameters
+        ----------
+        structure_name : Union[str, List[str]]
+            One of the filter areas given to vol_to_probs_by_filter, or None for no filter.
+
+        Raises
+        ------
+        KeyError
+            If the filter wasn't computed by vol_to_probs_by_filter since the image was last changed.
+        """
+        key = self._filter_key(structure_name)
+        if key not in self._filter_results:
+            raise KeyError(f'No projections of filter {structure_name!r}, run vol_to_probs_by_filter with it first.')
+        selection, row, projections = self._filter_results[key]
+        if structure_name is not None:
+            self.filter_area = structure_name
+        else:
+            self._filter_area = None
+        self._selection = selection
+        self.projections = projections
+        self._masked_projections = row
+
+    @staticmethod
+    def _filter_key(structure_name: Union[str, List[str]]) -> Union[str, Tuple[str], None]:
+        # Lists of names can't be dictionary keys, so they are kept as tuples
+        return tuple(structure_name) if isinstance(structure_name, list) else structure_name
+
+    @instrumented
+    def compile_filter(self, structure_name: Union[str, List[str]]) -> Tuple[np.array, np.array]:
+        """Compiles a filter area into a boolean vector over the source mask voxels, along with the flat
+        annotation indices of the whole area. Filters are compiled once per name (or list of names) and cached.
+
+        Parameters
+        ----------
+        structure_name : Union[str, List[str]]
+            A single structure name or list of structure names (which will be unioned together).
+
+        Returns
+        -------
+        Whether each source mask voxel is in the filter area, and the flat annotation indices of the area.
+        """
+        key = tuple(structure_name) if isinstance(structure_name, list) else (structure_name,)
+        if key not in self._compiled_filters:
+            mask = self.struct_ids_to_mask(self.struct_names_to_ids(list(key)))
+            self._compiled_filters[key] = (self._source_mask.mask_volume(mask).astype(bool), np.flatnonzero(mask))
+        return self._compiled_filters[key]
+
+    @property
+    def source_voxels(self) -> int:
+        """The number of source voxels, as used to normalize by source."""
+        if self._selection is not None:
+            return self._selection[2]
+        return self.image.sum()
+
+    @instrumented
+    def vol_to_probs(self, save: bool = True, factorized: bool = True, weighted: bool = False) -> np.array:
         """Takes the inner source image and computes the projections from each source voxel.
 
-        The source image must be a binary, {0,1}, image. The projections of each voxel are calculated
-        and then summed at the end. If desired, this resulting projections image can be saved.
+        Unless weighted, the source image must be a binary, {0,1}, image. The projections of each voxel are
+        calculated and then summed at the end. If desired, this resulting projections image can be saved.
+        If source voxels were selected with select_source, those are used instead of the image. If there is a
+        result cache, the factorized projections are taken from it when they are in it and added to it otherwise.
 
         Parameters
         ----------
         save : bool
             Whether to save the resulting projections image.
+        factorized : bool
+            Whether to sum the selected rows of the low rank weights matrix first and then take a single
+            product with the nodes matrix. This never builds the dense (n_selected x n_targets) block that
+            indexing the voxel array does, and gives the same result up to floating point error.
+        weighted : bool
+            Whether to treat the source image as voxel weights (e.g. an unthresholded probability map), so
+            that the projections of each nonzero voxel are scaled by its value before summing.
 
         Returns
         -------
@@ -223,29 +719,353 @@ class ProjPredictor:
         """
         if self.verbose:
             print('Converting source image to projection probabilities...')
-        data_flattened = self._source_mask.mask_volume(self.image)
-
-        row = self._voxel_array[data_flattened == 1].sum(axis=0)
-        np.nan_to_num(row, copy=False, nan=0.0)
-        return_volume = self._target_mask.map_masked_to_annotation(row)
+        with span(self.instrumentation, 'ProjPredictor.vol_to_probs:mask'):
+            selected, values = self._current_source_weights(weighted)
+        row = None
+        if factorized and self.result_cache is not None:
+            with span(self.instrumentation, 'ProjPredictor.vol_to_probs:result_cache'):
+                cache_key = self._result_key(selected, values)
+                row = self.result_cache.get(cache_key)
+        if row is None:
+            with span(self.instrumentation, 'ProjPredictor.vol_to_probs:matmul'):
+                if factorized:
+                    row = self._weight_sum(selected, values) @ self._voxel_array.nodes
+                else:
+                    row = (values[:, np.newaxis] * self._voxel_array[selected]).sum(axis=0)
+                np.nan_to_num(row, copy=False, nan=0.0)
+            if factorized and self.result_cache is not None:
+                self.result_cache.put(cache_key, row)
+        with span(self.instrumentation, 'ProjPredictor.vol_to_probs:map_to_annotation'):
+            return_volume = self._target_mask.map_masked_to_annotation(row)
 
         if save:
             self.projections = return_volume
+            self._masked_projections = row
 
         return return_volume
 
+    @instrumented
+    def vol_to_probs_batch(self, images: Union[np.array, List[np.array]], weighted: bool = False) -> np.array:
+        """Computes the projections of several source images at once.
+
+        Each image is masked by the source mask and turned into a row of a sparse indicator matrix, so that
+        the projections of all images are computed with a single indicator x weights x nodes product. The
+        images must be binary, {0,1}, unless weighted, and already permuted, padded and reflected into the
+        annotation space (as the stored image is). The stored image and projections are left untouched.
+
+        Parameters
+        ----------
+        images : Union[np.array, List[np.array]]
+            A stack of source images, with the images along the first axis, or a list of source images.
+        weighted : bool
+            Whether to treat the source images as voxel weights rather than binary images.
+
+        Returns
+        -------
+        An array of projection images, one along the first axis for each source image.
+        """
+        if self.verbose:
+            print(f'Converting {len(images)} source images to projection probabilities...')
+        if len(images) == 0:
+            return np.zeros((0,) + ANNOTATION_SHAPE, dtype=self.dtype)
+        selected, values = zip(*[self._source_weights(self._source_mask.mask_volume(image), weighted, self.dtype)
+                                 for image in images])
+        rows = self.project_selections(selected, values)
+        return np.stack([self._target_mask.map_masked_to_annotation(row) for row in rows])
+
+    def _current_source_weights(self, weighted: bool = False) -> Tuple[np.array, np.array]:
+        """The source voxels and weights of the stored image, or of the selection made by select_source."""
+        if self._selection is not None:
+            return self._selection[:2]
+        return self._source_weights(self._masked_source(), weighted, self.dtype)
+
+    def mask_source(self, image: np.array) -> np.array:
+        """Returns an oriented image as a vector over the voxels of the source mask, e.g. to threshold it for
+        filtered_selection.
+
+        Parameters
+        ----------
+        image : np.array
+            An image in the orientation of the annotation (see orient_image).
+
+        Returns
+        -------
+        The values of the image at the source mask voxels.
+        """
+        return self._source_mask.mask_volume(image)
+
+    def _masked_source(self) -> np.array:
+        """The stored image as a vector over the voxels of the source mask, kept until the image changes."""
+        if self._masked_image is None:
+            self._masked_image = self.mask_source(self.image)
+        return self._masked_image
+
+    def _area_values(self,
+                     structure_name: Union[str, List[str]] = None,
+                     image: np.array = None) -> Tuple[np.array, int]:
+        """The values of the stored image (or of the given oriented image) over the whole annotation, or over a
+        filter area, for counting source voxels, along with the number of voxels of the area the image doesn't
+        cover. Those are the padding added when orienting an image, which is 0. An image set with set_raw_image is
+        read without orienting it."""
+        if image is not None or self._raw_image is None:
+            values = (self.image if image is None else image).ravel()
+            if structure_name is not None:
+                values = values[self.compile_filter(structure_name)[1]]
+            return values, 0
+        key = (self._raw_image.shape, self.y_mirror,
+               tuple(structure_name) if isinstance(structure_name, list) else structure_name)
+        if key not in self._raw_area_maps:
+            annotation_indices, image_indices = orientation_map(self._raw_image.shape, self.y_mirror)
+            if structure_name is None:
+                self._raw_area_maps[key] = (None, int(np.prod(ANNOTATION_SHAPE)) - len(image_indices))
+            else:
+                # The image voxel each annotation voxel comes from, -1 for padding
+                sources = np.full(int(np.prod(ANNOTATION_SHAPE)), -1)
+                sources[annotation_indices] = image_indices
+                area_sources = sources[self.compile_filter(structure_name)[1]]
+                in_image = area_sources >= 0
+                self._raw_area_maps[key] = (area_sources[in_image], int((~in_image).sum()))
+        area_sources, padding = self._raw_area_maps[key]
+        values = self._raw_image.ravel()
+        return (values if area_sources is None else values[area_sources]), padding
+
+    def reset_incremental(self) -> None:
+        """Forgets the summed weight rows kept by the last projection, so that the next one sums them from scratch
+        rather than updating them (see _weight_sum). Reading an image from a file does this, while setting an
+        image in memory keeps them, as it may be an edit of the last one."""
+        self._weight_sum_state = None
+
+    def _weight_sum(self, selected: np.array, values: np.array) -> np.array:
+        """Sums the weight rows of the selected source voxels, scaled by their values.
+
+        The source values and the sum are kept, so that when only a few voxels differ from the previous call (e.g.
+        when nudging the threshold or editing the image by hand) the sum is updated with just the rows of the
+        voxels that changed. It is summed from scratch when more than half of the voxels changed, and after
+        INCREMENTAL_REFRESH updates in a row. It is always summed from scratch if incremental is off.
+
+        Parameters
+        ----------
+        selected : np.array
+            The indices of the source voxels in source mask space.
+        values : np.array
+            The weight of each selected voxel.
+
+        Returns
+        -------
+        The (rank,) sum of the scaled weight rows.
+        """
+        weights = self._voxel_array.weights
+        if not self.incremental:
+            self.reset_incremental()
+            return values @ weights[selected]
+        source_values = np.zeros(weights.shape[0], dtype=values.dtype)
+        source_values[selected] = values
+        if self._weight_sum_state is not None:
+            previous_values, weight_sum, updates = self._weight_sum_state
+            changed = np.flatnonzero(source_values != previous_values)
+            if (previous_values.dtype == source_values.dtype and 2 * len(changed) <= len(selected)
+                    and updates < INCREMENTAL_REFRESH):
+                if len(changed) > 0:
+                    weight_sum = weight_sum + (source_values[changed] - previous_values[changed]) @ weights[changed]
+                self._weight_sum_state = (source_values, weight_sum, updates + 1)
+                return weight_sum
+        weight_sum = values @ weights[selected]
+        self._weight_sum_state = (source_values, weight_sum, 0)
+        return weight_sum
+
+    @staticmethod
+    def _source_weights(data_flattened: np.array,
+                        weighted: bool = False,
+                        dtype: np.dtype = np.float64) -> Tuple[np.array, np.array]:
+        """Finds the source voxels that contribute to the projections and the weight each one gets.
+
+        Parameters
+        ----------
+        data_flattened : np.array
+            The source image masked by the source mask.
+        weighted : bool
+            Whether the values of the image are used as weights. Otherwise voxels equal to 1 get weight 1.
+        dtype : np.dtype
+            The floating point type of the weights, which should match the voxel array.
+
+        Returns
+        -------
+        The indices of the contributing voxels in source mask space and their float weights.
+        """
+        if weighted:
+            selected = np.flatnonzero(data_flattened)
+            return selected, data_flattened[selected].astype(dtype)
+        selected = np.flatnonzero(data_flattened == 1)
+        return selected, np.ones(len(selected), dtype=dtype)
+
+    @instrumented
+    def precision_error(self, weighted: bool = False) -> dict:
+        """Measures how far the projections of the current source voxels, computed in the predictor's dtype, are
+        from the same projections computed in float64, and bounds how far they can be.
+
+        The bound is the standard one for floating point dot products, gamma_n = n * u / (1 - n * u) times the
+        projections computed with absolute values, where u is the unit roundoff of the dtype and n the number of
+        selected voxels plus the rank (plus 2 for the rounding of the weights and nodes to the dtype). The
+        measured error leaves out that rounding, as the float64 weights and nodes are not kept. Computing the
+        float64 projections copies the nodes matrix as float64.
+
+        Parameters
+        ----------
+        weighted : bool
+            Whether to treat the source image as voxel weights, as in vol_to_probs.
+
+        Returns
+        -------
+        A dictionary with the dtype, the largest absolute error, the largest absolute error relative to the
+        largest projection, and the bounds on both.
+        """
+        selected, values = self._current_source_weights(weighted)
+        weights = self._voxel_array.weights[selected]
+        nodes = self._voxel_array.nodes
+        row = np.nan_to_num((values @ weights) @ nodes, nan=0.0)
+        exact = np.nan_to_num((values.astype(np.float64) @ weights.astype(np.float64)) @ nodes.astype(np.float64),
+                              nan=0.0)
+        magnitude = np.nan_to_num((np.abs(values).astype(np.float64) @ np.abs(weights).astype(np.float64))
+                                  @ np.abs(nodes).astype(np.float64), nan=0.0)
+        n = len(selected) + nodes.shape[0] + (2 if self.dtype != np.float64 else 0)
+        unit_roundoff = np.finfo(self.dtype).eps / 2
+        gamma = n * unit_roundoff / (1 - n * unit_roundoff)
+        scale = float(np.abs(exact).max()) if len(exact) else 0.0
+        scale = scale if scale > 0 else 1.0
+        max_abs_error = float(np.abs(row - exact).max()) if len(exact) else 0.0
+        max_abs_bound = float(gamma * magnitude.max()) if len(magnitude) else 0.0
+        return {'dtype': str(self.dtype),
+                'max_abs_error': max_abs_error,
+                'max_rel_error': max_abs_error / scale,
+                'max_abs_error_bound': max_abs_bound,
+                'max_rel_error_bound': max_abs_bound / scale}
+
+    def _result_key(self, selected: np.array, values: np.array) -> str:
+        """The result cache key of the projections of the given source voxels and weights."""
+        return ResultCache.key(selected, values, self.model_version)
+
+    def project_selections(self, selected: List[np.array], values: List[np.array]) -> np.array:
+        """Projects several sources, given as their selected source voxels and weights, with a single
+        indicator x weights x nodes product. Sources in the result cache, if there is one, are taken from it and
+        the others are added to it.
+
+        Parameters
+        ----------
+        selected : List[np.array]
+            The selected source voxels of each source, as indices into the source mask vector (see
+            filtered_selection).
+        values : List[np.array]
+            The weight of each selected voxel of each source.
+
+        Returns
+        -------
+        A dense (n_sources x n_target_voxels) array of projections in target mask space.
+        """
+        if self.result_cache is None:
+            return self._project_indicator(self._indicator_matrix(selected, values))
+        keys = [self._result_key(s, v) for s, v in zip(selected, values)]
+        rows = [self.result_cache.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            computed = self._project_indicator(self._indicator_matrix([selected[i] for i in missing],
+                                                                      [values[i] for i in missing]))
+            for i, row in zip(missing, computed):
+                rows[i] = row
+                self.result_cache.put(keys[i], row)
+        if not rows:
+            return np.zeros((0, self._voxel_array.nodes.shape[1]), dtype=self.dtype)
+        return np.stack(rows)
+
+    def _indicator_matrix(self, selected: List[np.array], values: List[np.array]) -> sparse.csr_matrix:
+        """Stacks the selected source voxels and weights of several sources into a sparse
+        (n_sources x n_source_voxels) matrix, one row per source."""
+        return sparse.csr_matrix((np.concatenate(values),
+                                  np.concatenate(selected),
+                                  np.cumsum([0] + [len(s) for s in selected])),
+                                 shape=(len(selected), self._voxel_array.weights.shape[0]))
+
+    def _project_indicator(self, indicator: sparse.spmatrix) -> np.array:
+        """Multiplies a sparse (n x n_source_voxels) matrix through the factorized voxel array.
+
+        Parameters
+        ----------
+        indicator : sparse.spmatrix
+            Matrix whose rows give the weight of each source voxel.
+
+        Returns
+        -------
+        A dense (n x n_target_voxels) array of projections in target mask space, with NaNs set to 0.
+        """
+        rows = np.asarray((indicator @ self._voxel_array.weights) @ self._voxel_array.nodes)
+        np.nan_to_num(rows, copy=False, nan=0.0)
+        return rows
+
     def _permute_pad_reflect(self) -> None:
         """Permutes, pads, and reflects the stored image to match it to the 100um annotation.
 
-        Used internally when the image is set. Currently has hard coded numbers.
+        Used internally when the image is set.
         """
         if self.verbose:
             print('Permuting, padding, and reflecting source image...')
-        self._image = np.transpose(self._image, (1, 0, 2))
-        self._image = np.pad(self._image, ((0, 132 - 88), (80 - 65 - 10, 10), (13, 114 - 88 - 13)), 'constant')
-        self._image = np.flip(self._image, axis=(0, 1))
-        if self.y_mirror:
-            self._image = np.fliplr(self._image)
+        self._image = self.orient_image(self._image, self.y_mirror)
+
+    @staticmethod
+    def orient_image(image: np.array, y_mirror: bool = False) -> np.array:
+        """Permutes, pads, and reflects an image to match it to the 100um annotation and returns it.
+
+        This is done with a single gather through the precomputed orientation_map of the image's shape.
+
+        Parameters
+        ----------
+        image : np.array
+            The image, in the orientation it was acquired in.
+        y_mirror : bool
+            Whether the image should be mirrored along the median plane.
+
+        Returns
+        -------
+        The oriented image.
+        """
+        annotation_indices, image_indices = orientation_map(image.shape, y_mirror)
+        oriented = np.zeros(ANNOTATION_SHAPE, dtype=image.dtype)
+        oriented.ravel()[annotation_indices] = image.ravel()[image_indices]
+        return oriented
+
+    def mask_raw_image(self, image: np.array, y_mirror: bool = False) -> np.array:
+        """Maps an image, in the orientation it was acquired in, straight to the source mask vector, with a single
+        gather and without building the oriented volume. This is source_mask.mask_volume(orient_image(image)).
+
+        Parameters
+        ----------
+        image : np.array
+            The image, in the orientation it was acquired in.
+        y_mirror : bool
+            Whether the image should be mirrored along the median plane.
+
+        Returns
+        -------
+        The image as a vector over the voxels of the source mask.
+        """
+        source_indices, image_indices = self._source_orientation_map(image.shape, y_mirror)
+        masked = np.zeros(self._voxel_array.weights.shape[0], dtype=image.dtype)
+        masked[source_indices] = image.ravel()[image_indices]
+        return masked
+
+    def _source_orientation_map(self, image_shape: Tuple[int, int, int], y_mirror: bool) -> Tuple[np.array, np.array]:
+        """Composes orientation_map with the source mask, giving the source mask vector positions that come from
+        an image of the given shape and the flat image index each of them comes from."""
+        key = (tuple(image_shape), y_mirror)
+        if key not in self._source_orientation_maps:
+            source_mask = self._source_mask
+            if not isinstance(source_mask, VoxelSnapshot.IndexMask):
+                source_mask = VoxelSnapshot.IndexMask.from_mask(source_mask)
+            # Position of every annotation voxel in the source mask vector, -1 if it's not in the mask
+            positions = np.full(int(np.prod(ANNOTATION_SHAPE)), -1)
+            positions[source_mask.indices] = np.arange(len(source_mask.indices))
+            annotation_indices, image_indices = orientation_map(key[0], y_mirror)
+            in_mask = positions[annotation_indices] >= 0
+            self._source_orientation_maps[key] = (positions[annotation_indices][in_mask], image_indices[in_mask])
+        return self._source_orientation_maps[key]
 
     def _filter_by_id(self, structure_id: Union[int, List[int]]) -> None:
         """Given an id or a list of ids, only preserves voxels from the original image that are included
@@ -259,7 +1079,9 @@ class ProjPredictor:
         if self.verbose:
             print('Filtering source image by selected structures...')
         mask = self.struct_ids_to_mask(structure_id)
-        self._image = self._image * mask
+        image = self.image * mask
+        self._image_changed()
+        self._image = image
 
     def struct_ids_to_mask(self, structure_id: Union[int, List[int]]) -> np.array:
         """
@@ -273,13 +1095,208 @@ class ProjPredictor:
 
         Returns
         -------
-        Binary array with a 1 where at least one of the given structures is present.
+        Binary array with a 1 where at least one of the given structures is present. It is shared with the
+        structure mask cache, so it is read only.
+        """
+        return self._cached_structure_mask(structure_id)[0]
+
+    def struct_ids_to_volume(self, structure_id: Union[int, List[int]]) -> int:
+        """
+        Takes in structure ids or id and counts the voxels in the union of those structures.
+
+        Parameters
+        ----------
+        structure_id : Union[int, List[int]]
+            A single id or a list of ids (which will be unioned together).
+
+        Returns
+        -------
+        The number of voxels in the mask returned by struct_ids_to_mask.
+        """
+        return self._cached_structure_mask(structure_id)[1]
+
+    def _cached_structure_mask(self, structure_id: Union[int, List[int]]) -> Tuple[np.array, int]:
+        """Looks up the mask and voxel count of the given structure(s) in the structure mask cache, making
+        and caching them if they are not there. At most mask_cache_size masks are kept.
+        """
+        if not isinstance(structure_id, list):
+            structure_id = [structure_id]
+        key = tuple(sorted(set(structure_id)))
+        if key in self._mask_cache:
+            self._mask_cache.move_to_end(key)
+            return self._mask_cache[key]
+        # The same mask as ReferenceSpace.make_structure_mask, with the descendants taken from the structure index
+        # rather than resolved through the structure tree for every mask
+        with span(self.instrumentation, 'ProjPredictor.make_structure_mask'):
+            descendant_ids = set().union(*(self.structure_index.descendant_ids(i) for i in key))
+            annotation = self._cache.get_reference_space().annotation
+            mask = np.isin(annotation, sorted(descendant_ids)).astype(np.uint8)
+        mask.setflags(write=False)
+        entry = (mask, int(mask.sum()))
+        if self.mask_cache_size > 0:
+            self._mask_cache[key] = entry
+            while len(self._mask_cache) > self.mask_cache_size:
+                self._mask_cache.popitem(last=False)
+        return entry
+
+    @instrumented
+    def region_aggregation_matrix(self, structure_id: Union[int, List[int]]) -> Tuple[sparse.csr_matrix, np.array]:
+        """
+        Builds a sparse (n_structures x n_target_voxels) matrix in target mask space with a 1 wherever a target
+        voxel is in a structure, so that the summed projections to every structure are a single sparse
+        product with the masked projections. The matrices are built once per list of ids and then cached.
+
+        Parameters
+        ----------
+        structure_id : Union[int, List[int]]
+            A single id or a list of ids, one row of the matrix per id.
+
+        Returns
+        -------
+        The aggregation matrix and the number of voxels in each structure, as used to normalize by target.
         """
         if not isinstance(structure_id, list):
             structure_id = [structure_id]
-        mask = self._cache.get_reference_space().make_structure_mask(structure_id)
-        return mask
+        key = tuple(structure_id)
+        if key not in self._aggregation_cache:
+            if self.verbose:
+                print('Building region aggregation matrix...')
+            columns = [np.flatnonzero(self._target_mask.mask_volume(self.struct_ids_to_mask(i))) for i in key]
+            aggregation = sparse.csr_matrix((np.ones(sum(len(c) for c in columns)),
+                                             np.concatenate(columns),
+                                             np.cumsum([0] + [len(c) for c in columns])),
+                                            shape=(len(columns), self._voxel_array.nodes.shape[1]))
+            volumes = np.array([self.struct_ids_to_volume(i) for i in key])
+            self._aggregation_cache[key] = (aggregation, volumes)
+        return self._aggregation_cache[key]
+
+    @instrumented
+    def build_region_model(self, structure_name: Union[str, List[str]]) -> RegionModel:
+        """
+        Builds a region model for the given target structures and makes it the predictor's region model.
+        The nodes matrix is summed over the voxels of each structure, giving a (rank x n_structures) matrix, so
+        that per-area projection strengths for a source image no longer need the projections in voxel space.
 
+        Parameters
+        ----------
+        structure_name : Union[str, List[str]]
+            A string or list of strings denoting the target areas of the model.
+
+        Returns
+        -------
+        The new region model.
+        """
+        if self.verbose:
+            print('Building region model...')
+        self.assert_valid_structure_name(structure_name)
+        ids = self.struct_names_to_ids(structure_name)
+        if not isinstance(structure_name, list):
+            structure_name = [structure_name]
+        aggregation, volumes = self.region_aggregation_matrix(ids)
+        self.region_model = RegionModel.from_nodes(self._voxel_array.nodes, aggregation, structure_name, ids,
+                                                   volumes)
+        return self.region_model
+
+    def save_region_model(self, fname: str) -> None:
+        """Saves the region model to a .npz file, which can be given as region_model_file to later ProjPredictors.
+
+        Parameters
+        ----------
+        fname : str
+            The file name of the file to be saved.
+
+        Returns
+        -------
+        None
+        """
+        if self.verbose:
+            print(f'Saving region model to: {fname}')
+        self.region_model.save(fname)
+
+    @instrumented
+    def region_profile(self, weighted: bool = False) -> np.array:
+        """Computes the summed projection strength from the source image to every structure of the region model,
+        as (sum of the selected weight rows) @ reduced nodes.
+
+        Parameters
+        ----------
+        weighted : bool
+            Whether to treat the source image as voxel weights, as in vol_to_probs.
+
+        Returns
+        -------
+        The projection strength to each structure, in the order of the region model's structure names.
+        """
+        if self.verbose:
+            print('Computing region profile of source image...')
+        selected, values = self._current_source_weights(weighted)
+        return self.region_model.profile(self._weight_sum(selected, values))
+
+    @instrumented
+    def threshold_sweep(self,
+                        thresholds: Union[List[float], np.array],
+                        structure_name: Union[str, List[str]] = None,
+                        region_profile: bool = False) -> Tuple[np.array, np.array]:
+        """Computes the projections of the stored image thresholded at each of many thresholds in one pass.
+
+        The masked image values are sorted once, so that the voxels above each threshold are a prefix of the
+        sorted voxels. The weight rows of the voxels between consecutive thresholds are summed with
+        np.add.reduceat and accumulated with a cumulative sum, so every source voxel's weight row is read once
+        however many thresholds there are. Each threshold gives the same projections and source voxel count as
+        select_source(threshold, structure_name) followed by vol_to_probs, up to floating point error. The
+        stored image and selection are left as they are.
+
+        Parameters
+        ----------
+        thresholds : Union[List[float], np.array]
+            The thresholds. Voxels above a threshold are selected.
+        structure_name : Union[str, List[str]]
+            A single structure name or list of structure names (which will be unioned together) to filter by.
+        region_profile : bool
+            Whether to return the region profile (see region_profile) of each threshold rather than its
+            projections.
+
+        Returns
+        -------
+        An (n_thresholds x n_target_voxels) array of projections in target mask space (see
+        map_masked_to_annotation to get volumes), or an (n_thresholds x n_structures) array of region profiles,
+        and the number of source voxels at each threshold, both in the order of the given thresholds.
+        """
+        thresholds = np.asarray(thresholds, dtype=float)
+        if self.verbose:
+            print(f'Sweeping {len(thresholds)} thresholds...')
+        masked = self._masked_source()
+        candidates = np.flatnonzero(masked > thresholds.min()) if len(thresholds) else np.array([], dtype=int)
+        if structure_name is not None:
+            candidates = candidates[self.compile_filter(structure_name)[0][candidates]]
+        values, padding = self._area_values(structure_name)
+        # Thresholds from highest to lowest, so that the voxels above each one extend those above the previous
+        descending = np.argsort(-thresholds, kind='stable')
+        order = candidates[np.argsort(-masked[candidates], kind='stable')]
+        sorted_values = masked[order][::-1]
+        counts = len(order) - np.searchsorted(sorted_values, thresholds[descending], side='right')
+        sorted_image = np.sort(values)
+        source_voxels = len(sorted_image) - np.searchsorted(sorted_image, thresholds, side='right')
+        source_voxels += padding * (thresholds < 0)
+
+        weights = self._voxel_array.weights
+        rows = weights[order[:counts[-1]]] if len(counts) else weights[:0]
+        bounds = np.concatenate(([0], counts))
+        nonempty = np.flatnonzero(np.diff(bounds) > 0)
+        weight_sums = np.zeros((len(thresholds), weights.shape[1]), dtype=weights.dtype)
+        if len(nonempty) > 0:
+            weight_sums[nonempty] = np.add.reduceat(rows, bounds[nonempty], axis=0)
+        np.cumsum(weight_sums, axis=0, out=weight_sums)
+        # Back into the order the thresholds were given in
+        weight_sums[descending] = weight_sums.copy()
+
+        if region_profile:
+            return self.region_model.profile(weight_sums), source_voxels
+        projections = weight_sums @ self._voxel_array.nodes
+        np.nan_to_num(projections, copy=False, nan=0.0)
+        return projections, source_voxels
+
+    @instrumented
     def filter_by_name(self, structure_name: Union[str, List[str]]) -> None:
         """Given a structure name or a list of structure names, only preserves voxels from the original image
         that are included in at least one of the given structures.
@@ -296,7 +1313,7 @@ class ProjPredictor:
 
     def struct_names_to_ids(self, structure_name: Union[str, List[str]]) -> List[int]:
         """
-        Takes in structure name(s) and returns their id(s).
+        Takes in structure name(s) and returns their id(s). Acronyms can be given in place of names.
 
         Parameters
         ----------
@@ -307,12 +1324,102 @@ class ProjPredictor:
         -------
         List of ints with each id in the same order as the structures were given.
         """
+        return self.structure_index.ids(structure_name)
+
+    @instrumented
+    def proj_by_area(self, structure_name: Union[str, List[str]]) -> pd.DataFrame:
+        """
+        Computes the summed projection strength from the source area to each target area once, along with the
+        source voxel count and target volumes, and returns every normalization of it as a column. It will have
+        as many rows as target areas, or one if structure_name is just a string and not a list.
+
+        If no projections have been computed or set and the region model has all of the target areas, the
+        strengths come straight from the region model without building the projections.
+
+        Parameters
+        ----------
+        structure_name : Union[str, List[str]]
+            A string or list of strings denoting the target areas to filter by.
+
+        Returns
+        -------
+        A DataFrame with the source area, target area, source and target voxel counts, and one projection
+        strength column per normalization (see NORMALIZATION_COLUMNS).
+        """
+        self.assert_valid_structure_name(structure_name)
+        ids = self.struct_names_to_ids(structure_name)
         if not isinstance(structure_name, list):
             structure_name = [structure_name]
-        structures = self._cache.get_structure_tree().get_structures_by_name(structure_name)
-        ids = [structure['id'] for structure in structures]
-        return ids
+        columns = None
+        if self.region_model is not None and self._projections is None:
+            columns = self.region_model.columns(structure_name)
+        if columns is not None:
+            proj_strengths = self.region_profile()[columns]
+            volumes = self.region_model.volumes[columns]
+        else:
+            aggregation, volumes = self.region_aggregation_matrix(ids)
+            proj_strengths = aggregation @ self.masked_projections
+        return proj_by_area_frame(self.source_area, structure_name, self.source_voxels, volumes, proj_strengths,
+                                  self.filter_area)
+
+    @instrumented
+    def save_proj_by_area_variants(self,
+                                   structure_name: Union[str, List[str]],
+                                   fname: str = 'proj_by_area',
+                                   long_form: bool = False) -> None:
+        """
+        Saves the Pandas array from proj_by_area, which has every normalization of the projection strengths as
+        a column, so that a single file replaces one save_proj_by_area file per normalization.
+
+        Parameters
+        ----------
+        structure_name : Union[str, List[str]]
+            A string or list of strings denoting the target areas to filter and save by.
+        fname : str
+            The file name of the file to be saved.
+        long_form : bool
+            Whether to save the normalizations as rows in the save_proj_by_area layout (see variants_to_long), which
+            is what readers of the per-normalization files filter on, rather than as columns.
+
+        Returns
+        -------
+        None
+        """
+        if self.verbose:
+            print(f'Saving projections by area (all normalizations) to: {fname}')
+        df = self.proj_by_area(structure_name)
+        pd.to_pickle(variants_to_long(df) if long_form else df, fname)
+
+    @instrumented
+    def append_proj_by_area_dataset(self,
+                                    structure_name: Union[str, List[str]],
+                                    root: str,
+                                    brain: str = None) -> None:
+        """
+        Appends the projection strengths from proj_by_area, in every normalization, to a Parquet dataset
+        partitioned by source area, filter area and normalization (see ProjDataset). A slice of all brains can
+        then be read in one go with ProjDataset.load_dataset.
+
+        Parameters
+        ----------
+        structure_name : Union[str, List[str]]
+            A string or list of strings denoting the target areas to filter and save by.
+        root : str
+            The root directory of the dataset.
+        brain : str
+            The name of the brain the source image came from, stored in the Brain column. If given, the files
+            are named after it, so appending the same brain again replaces its rows rather than duplicating them.
 
+        Returns
+        -------
+        None
+        """
+        if self.verbose:
+            print(f'Appending projections by area to dataset: {root}')
+        rows = ProjDataset.to_dataset_rows(variants_to_long(self.proj_by_area(structure_name)), brain)
+        ProjDataset.append_to_dataset(rows, root, basename=brain)
+
+    @instrumented
     def save_proj_by_area(self,
                           structure_name: Union[str, List[str]],
                           normalize_source: bool = False,
@@ -340,27 +1447,80 @@ class ProjPredictor:
         """
         if self.verbose:
             print(f'Saving projections by area to: {fname}')
-        self.assert_valid_structure_name(structure_name)
-        ids = self.struct_names_to_ids(structure_name)
-        if not isinstance(structure_name, list):
-            structure_name = [structure_name]
+        df = variants_to_long(self.proj_by_area(structure_name))
+        # Callers have passed truthy non-booleans as the flags, which used to select the normalized variant
+        df = df[(df['Normalized by source'] == bool(normalize_source))
+                & (df['Normalized by target'] == bool(normalize_target))]
+        pd.to_pickle(df.reset_index(drop=True), fname)
+
+
+def proj_by_area_frame(source_area: str,
+                       structure_name: List[str],
+                       source_voxels: int,
+                       volumes: np.array,
+                       proj_strengths: np.array,
+                       filter_area: Union[str, List[str]] = None) -> pd.DataFrame:
+    """Builds the DataFrame returned by ProjPredictor.proj_by_area from the summed projection strength to each
+    target area, with one column per normalization (see NORMALIZATION_COLUMNS).
+
+    Parameters
+    ----------
+    source_area : str
+        The name of the source area.
+    structure_name : List[str]
+        The names of the target areas.
+    source_voxels : int
+        The number of source voxels, to normalize by source.
+    volumes : np.array
+        The number of voxels of each target area, to normalize by target.
+    proj_strengths : np.array
+        The summed projection strength to each target area.
+    filter_area : Union[str, List[str]]
+        The area(s) the source voxels were filtered by, if any.
+
+    Returns
+    -------
+    The DataFrame, with as many rows as target areas.
+    """
+    num_target_structs = len(structure_name)
+    proj_dict = {'Source area': [source_area] * num_target_structs,
+                 'Target area': structure_name,
+                 'Source voxels': [source_voxels] * num_target_structs,
+                 'Target voxels': volumes}
+    for (normalize_source, normalize_target), column in NORMALIZATION_COLUMNS.items():
+        normalized = proj_strengths
         if normalize_target:
-            proj_strengths = [(self.struct_ids_to_mask(i) * self.projections).sum() /
-                              self.struct_ids_to_mask(i).sum() for i in ids]
-        else:
-            proj_strengths = [(self.struct_ids_to_mask(i) * self.projections).sum() for i in ids]
-        proj_strengths = np.array(proj_strengths)
-        source_area_voxels = self.image.sum()
+            normalized = normalized / volumes
         if normalize_source:
-            proj_strengths = proj_strengths / source_area_voxels
-        num_target_structs = len(structure_name)
-        proj_dict = {'Source area': [self.source_area] * num_target_structs,
-                     'Target area': structure_name,
-                     'Projection strength': proj_strengths,
-                     'Normalized by source': [normalize_source] * num_target_structs,
-                     'Normalized by target': [normalize_target] * num_target_structs
-                     }
-        if self.filter_area is not None:
-            proj_dict['Filter area'] = [self.filter_area] * num_target_structs
-        df = pd.DataFrame(proj_dict)
-        pd.to_pickle(df, fname)
+            normalized = normalized / source_voxels
+        proj_dict[column] = normalized
+    if filter_area is not None:
+        proj_dict['Filter area'] = [filter_area] * num_target_structs
+    return pd.DataFrame(proj_dict)
+
+
+def variants_to_long(df: pd.DataFrame) -> pd.DataFrame:
+    """Reshapes a proj_by_area DataFrame, with one column per normalization, into the layout written by
+    save_proj_by_area: a single 'Projection strength' column and boolean 'Normalized by source' and
+    'Normalized by target' columns, with one row per target area and normalization.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        A DataFrame as returned by ProjPredictor.proj_by_area.
+
+    Returns
+    -------
+    The long form DataFrame.
+    """
+    id_columns = [column for column in ('Source area', 'Target area', 'Filter area') if column in df.columns]
+    variants = []
+    for (normalize_source, normalize_target), column in NORMALIZATION_COLUMNS.items():
+        variant = df[id_columns[:2]].copy()
+        variant['Projection strength'] = df[column]
+        variant['Normalized by source'] = normalize_source
+        variant['Normalized by target'] = normalize_target
+        for id_column in id_columns[2:]:
+            variant[id_column] = df[id_column]
+        variants.append(variant)
+    return pd.concat(variants, ignore_index=True)
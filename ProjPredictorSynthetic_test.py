@@ -0,0 +1,271 @@
+import numpy as np
+import os
+import pandas as pd
+import pytest
+from ProjPredictor import ProjPredictor
+from SyntheticCache import SyntheticVoxelModelCache
+
+AREAS = ['Somatomotor areas', 'Visual areas', 'Thalamus', 'Cerebellar nuclei']
+FILTERS = ['Cerebellar nuclei', ['Dentate nucleus', 'Interposed nucleus']]
+THRESHOLD = 0.98
+
+
+@pytest.fixture(scope='module')
+def cache() -> SyntheticVoxelModelCache:
+    return SyntheticVoxelModelCache(seed=0)
+
+
+@pytest.fixture(scope='module')
+def raw_image() -> np.array:
+    return np.random.default_rng(0).random((65, 88, 88))
+
+
+def make_predictor(cache: SyntheticVoxelModelCache, **kwargs) -> ProjPredictor:
+    return ProjPredictor(cache=cache, source_area='Dentate nucleus', **kwargs)
+
+
+def baseline_orient(image: np.array, y_mirror: bool = False) -> np.array:
+    """The transpose, pad and flip _permute_pad_reflect did before orient_image."""
+    image = np.transpose(image, (1, 0, 2))
+    image = np.pad(image, ((0, 132 - 88), (80 - 65 - 10, 10), (13, 114 - 88 - 13)), 'constant')
+    image = np.flip(image, axis=(0, 1))
+    if y_mirror:
+        image = np.fliplr(image)
+    return image
+
+
+def baseline_mask(cache: SyntheticVoxelModelCache, structure_name) -> np.array:
+    names = structure_name if isinstance(structure_name, list) else [structure_name]
+    ids = [structure['id'] for structure in cache.get_structure_tree().get_structures_by_name(names)]
+    return cache.get_reference_space().make_structure_mask(ids)
+
+
+_baselines = {}
+
+
+def baseline_projections(cache: SyntheticVoxelModelCache,
+                         raw_image: np.array,
+                         thresh: float,
+                         structure_name=None):
+    """threshold, filter_by_name and vol_to_probs as they were: the dense voxel array rows of the thresholded and
+    filtered image, summed a few at a time to keep the dense blocks small. Returns the projections and the number
+    of source voxels, which are kept as every test uses the same cache and image."""
+    key = (thresh, str(structure_name))
+    if key not in _baselines:
+        _baselines[key] = _baseline_projections(cache, raw_image, thresh, structure_name)
+    return _baselines[key]
+
+
+def _baseline_projections(cache, raw_image, thresh, structure_name):
+    image = baseline_orient(raw_image) > thresh
+    if structure_name is not None:
+        image = image * baseline_mask(cache, structure_name)
+    voxel_array, source_mask, target_mask = cache.get_voxel_connectivity_array()
+    selected = np.flatnonzero(source_mask.mask_volume(image) == 1)
+    row = np.zeros(voxel_array.nodes.shape[1])
+    for start in range(0, len(selected), 32):
+        row += voxel_array[selected[start:start + 32]].sum(axis=0)
+    return target_mask.map_masked_to_annotation(row), image.sum()
+
+
+@pytest.mark.parametrize('y_mirror', [False, True])
+def test_orient_image_matches_transpose_pad_flip(raw_image, y_mirror):
+    np.testing.assert_array_equal(ProjPredictor.orient_image(raw_image, y_mirror),
+                                  baseline_orient(raw_image, y_mirror))
+
+
+@pytest.mark.parametrize('structure_name', FILTERS)
+@pytest.mark.parametrize('factorized', [True, False])
+def test_threshold_filter_vol_to_probs(cache, raw_image, structure_name, factorized):
+    # The dense path builds an (n_selected x n_targets) block, so it gets fewer voxels
+    thresh = THRESHOLD if factorized else 0.995
+    pp = make_predictor(cache)
+    pp.image = raw_image
+    pp.threshold(thresh)
+    pp.filter_by_name(structure_name)
+    expected, source_voxels = baseline_projections(cache, raw_image, thresh, structure_name)
+    np.testing.assert_allclose(pp.vol_to_probs(factorized=factorized), expected, rtol=1e-10)
+    assert pp.source_voxels == source_voxels
+
+
+@pytest.mark.parametrize('structure_name', FILTERS)
+@pytest.mark.parametrize('raw', [False, True])
+def test_select_source(cache, raw_image, structure_name, raw):
+    pp = make_predictor(cache)
+    if raw:
+        pp.set_raw_image(raw_image)
+    else:
+        pp.set_oriented_image(ProjPredictor.orient_image(raw_image))
+    pp.select_source(THRESHOLD, structure_name)
+    expected, source_voxels = baseline_projections(cache, raw_image, THRESHOLD, structure_name)
+    np.testing.assert_allclose(pp.vol_to_probs(), expected, rtol=1e-10)
+    assert pp.source_voxels == source_voxels
+
+
+def test_vol_to_probs_batch(cache, raw_image):
+    pp = make_predictor(cache)
+    images = [(baseline_orient(raw_image) > THRESHOLD) * baseline_mask(cache, structure_name)
+              for structure_name in FILTERS]
+    projections = pp.vol_to_probs_batch(images)
+    for structure_name, projection in zip(FILTERS, projections):
+        np.testing.assert_allclose(projection, baseline_projections(cache, raw_image, THRESHOLD, structure_name)[0],
+                                   rtol=1e-10)
+    assert pp.vol_to_probs_batch([]).shape == (0, 132, 80, 114)
+
+
+def test_vol_to_probs_by_filter(cache, raw_image):
+    pp = make_predictor(cache)
+    pp.set_raw_image(raw_image)
+    projections = pp.vol_to_probs_by_filter(FILTERS, THRESHOLD)
+    for structure_name in FILTERS:
+        expected, source_voxels = baseline_projections(cache, raw_image, THRESHOLD, structure_name)
+        key = structure_name if isinstance(structure_name, str) else tuple(structure_name)
+        np.testing.assert_allclose(projections[key], expected, rtol=1e-10)
+        pp.select_filter(structure_name)
+        np.testing.assert_allclose(pp.projections, expected, rtol=1e-10)
+        assert pp.source_voxels == source_voxels
+
+
+def test_threshold_sweep(cache, raw_image):
+    pp = make_predictor(cache)
+    pp.set_oriented_image(ProjPredictor.orient_image(raw_image))
+    thresholds = [0.99, THRESHOLD, 0.985]
+    projections, source_voxels = pp.threshold_sweep(thresholds, FILTERS[0])
+    _, _, target_mask = cache.get_voxel_connectivity_array()
+    for thresh, row, count in zip(thresholds, projections, source_voxels):
+        expected, expected_count = baseline_projections(cache, raw_image, thresh, FILTERS[0])
+        np.testing.assert_allclose(target_mask.map_masked_to_annotation(row), expected, rtol=1e-10)
+        assert count == expected_count
+
+
+@pytest.mark.parametrize('incremental', [True, False])
+def test_incremental_weight_sum(cache, raw_image, incremental):
+    # Nudging the threshold changes a few voxels, which the incremental path adds and removes from the last sum
+    pp = make_predictor(cache, incremental=incremental)
+    pp.set_raw_image(raw_image)
+    for thresh in [THRESHOLD, 0.981, THRESHOLD, 0.979, 0.99]:
+        pp.select_source(thresh, FILTERS[0])
+        expected, _ = baseline_projections(cache, raw_image, thresh, FILTERS[0])
+        np.testing.assert_allclose(pp.vol_to_probs(), expected, rtol=1e-10)
+    assert (pp._weight_sum_state is not None) == incremental
+    pp.reset_incremental()
+    assert pp._weight_sum_state is None
+
+
+def test_region_profile_matches_voxel_path(cache, raw_image):
+    pp = make_predictor(cache)
+    pp.set_raw_image(raw_image)
+    pp.select_source(THRESHOLD, FILTERS[0])
+    pp.build_region_model(AREAS)
+    expected, _ = baseline_projections(cache, raw_image, THRESHOLD, FILTERS[0])
+    np.testing.assert_allclose(pp.region_profile(),
+                               [(baseline_mask(cache, area) * expected).sum() for area in AREAS], rtol=1e-10)
+    pp.vol_to_probs()
+    voxel_table = pp.proj_by_area(AREAS)
+    pp.projections = None
+    pd.testing.assert_frame_equal(pp.proj_by_area(AREAS), voxel_table, rtol=1e-10)
+
+
+@pytest.mark.parametrize('normalize_source, normalize_target', [(False, False), ('yes', False), (False, 1),
+                                                                (True, True)])
+def test_save_proj_by_area(cache, raw_image, tmp_path, normalize_source, normalize_target):
+    pp = make_predictor(cache)
+    pp.image = raw_image
+    pp.threshold(THRESHOLD)
+    pp.filter_by_name(FILTERS[0])
+    pp.vol_to_probs()
+    fname = os.path.join(tmp_path, 'proj_by_area')
+    pp.save_proj_by_area(AREAS, normalize_source, normalize_target, fname=fname)
+
+    # The table save_proj_by_area wrote before, with the flags stored as booleans
+    projections, source_voxels = baseline_projections(cache, raw_image, THRESHOLD, FILTERS[0])
+    strengths = np.array([(baseline_mask(cache, area) * projections).sum() for area in AREAS])
+    if normalize_target:
+        strengths = strengths / np.array([baseline_mask(cache, area).sum() for area in AREAS])
+    if normalize_source:
+        strengths = strengths / source_voxels
+    expected = pd.DataFrame({'Source area': ['Dentate nucleus'] * len(AREAS),
+                             'Target area': AREAS,
+                             'Projection strength': strengths,
+                             'Normalized by source': [bool(normalize_source)] * len(AREAS),
+                             'Normalized by target': [bool(normalize_target)] * len(AREAS),
+                             'Filter area': [FILTERS[0]] * len(AREAS)})
+    pd.testing.assert_frame_equal(pd.read_pickle(fname), expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_float32_stays_within_the_precision_bound(cache, raw_image, weighted):
+    pp32 = make_predictor(cache, dtype='float32')
+    pp64 = make_predictor(cache)
+    assert pp32._voxel_array.weights.dtype == pp32._voxel_array.nodes.dtype == np.float32
+    assert pp64._voxel_array.weights.dtype == np.float64
+    image = ProjPredictor.orient_image(raw_image) * baseline_mask(cache, FILTERS[0])
+    if not weighted:
+        image = image > THRESHOLD
+    for pp in (pp32, pp64):
+        pp.set_oriented_image(image)
+    projections = pp32.vol_to_probs(weighted=weighted)
+    assert projections.dtype == pp32.masked_projections.dtype == np.float32
+    exact = pp64.vol_to_probs(weighted=weighted)
+    precision = pp32.precision_error(weighted)
+    assert precision['dtype'] == 'float32'
+    assert precision['max_abs_error'] <= precision['max_abs_error_bound']
+    # The bound also covers the rounding of the weights and nodes to float32, which the measured error leaves out
+    error = np.abs(projections.astype(np.float64) - exact).max()
+    assert 0 < error <= precision['max_abs_error_bound']
+    assert error / np.abs(exact).max() <= precision['max_rel_error_bound']
+    # float64 is exact to within its own, much smaller, bound
+    assert pp64.precision_error(weighted)['max_abs_error_bound'] < precision['max_abs_error_bound'] * 1e-6
+
+
+def test_float32_batch_filters_and_sweep(cache, raw_image):
+    pp = make_predictor(cache, dtype='float32')
+    pp.set_raw_image(raw_image)
+    assert pp.vol_to_probs_batch([ProjPredictor.orient_image(raw_image) > THRESHOLD]).dtype == np.float32
+    assert all(projections.dtype == np.float32
+               for projections in pp.vol_to_probs_by_filter(FILTERS, THRESHOLD).values())
+    assert pp.threshold_sweep([THRESHOLD], FILTERS[0])[0].dtype == np.float32
+
+
+def test_vol_to_probs_by_filter_without_a_filter(cache, raw_image):
+    pp = make_predictor(cache)
+    pp.set_raw_image(raw_image)
+    projections = pp.vol_to_probs_by_filter([FILTERS[0], None], THRESHOLD)
+    assert list(projections) == [FILTERS[0], None]
+    unfiltered = make_predictor(cache)
+    unfiltered.image = raw_image
+    unfiltered.threshold(THRESHOLD)
+    expected = unfiltered.vol_to_probs()
+    np.testing.assert_allclose(projections[None], expected, rtol=1e-10)
+    pp.select_filter(FILTERS[0])
+    pp.select_filter(None)
+    assert pp.filter_area is None
+    assert pp.source_voxels == unfiltered.source_voxels
+    np.testing.assert_allclose(pp.projections, expected, rtol=1e-10)
+
+
+def test_incremental_state_is_reset_for_new_files_but_kept_for_edits(cache, raw_image, tmp_path):
+    from skimage import io
+    pp = make_predictor(cache)
+    oriented = ProjPredictor.orient_image(raw_image)
+    pp.set_oriented_image(oriented)
+    pp.select_source(THRESHOLD, FILTERS[0])
+    pp.vol_to_probs()
+    # An edited image in memory keeps the weight sum, and updates it with the voxels that changed
+    edited = oriented.copy()
+    edited.ravel()[np.flatnonzero(oriented > THRESHOLD)[::10]] = 0
+    pp.set_oriented_image(edited)
+    pp.select_source(THRESHOLD, FILTERS[0])
+    assert pp._weight_sum_state is not None
+    updates = pp._weight_sum_state[2]
+    incremental = pp.vol_to_probs()
+    assert pp._weight_sum_state[2] == updates + 1
+    scratch = make_predictor(cache, incremental=False)
+    scratch.set_oriented_image(edited)
+    scratch.select_source(THRESHOLD, FILTERS[0])
+    np.testing.assert_allclose(incremental, scratch.vol_to_probs(), rtol=1e-10)
+    # An image read from a file is a new brain
+    image_file = os.path.join(tmp_path, 'image.tif')
+    io.imsave(image_file, raw_image.astype(np.float32), check_contrast=False)
+    pp.set_image_from_file(image_file)
+    assert pp._weight_sum_state is None
@@ -0,0 +1,110 @@
+import numpy as np
+from scipy import sparse
+from typing import List
+
+
+class RegionModel:
+    """A reduced voxel model in which the nodes matrix has been summed over the target voxels of each
+    target structure. The summed projections from a set of source voxels to every structure are then
+    (sum of their weight rows) @ reduced_nodes, without ever building the projections in target voxel space.
+
+    Attributes
+    ----------
+    structure_names : List[str]
+        The names of the target structures, in the order of the columns of reduced_nodes
+    structure_ids : np.array
+        The ids of the target structures
+    reduced_nodes : np.array
+        A (rank x n_structures) array, the nodes matrix summed over the voxels of each structure
+    volumes : np.array
+        The number of voxels in each structure, as used to normalize by target
+    """
+    def __init__(self,
+                 structure_names: List[str],
+                 structure_ids: np.array,
+                 reduced_nodes: np.array,
+                 volumes: np.array) -> None:
+        self.structure_names = list(structure_names)
+        self.structure_ids = np.asarray(structure_ids)
+        self.reduced_nodes = reduced_nodes
+        self.volumes = np.asarray(volumes)
+
+    @classmethod
+    def from_nodes(cls,
+                   nodes: np.array,
+                   aggregation: sparse.spmatrix,
+                   structure_names: List[str],
+                   structure_ids: List[int],
+                   volumes: np.array,
+                   block_size: int = 64) -> 'RegionModel':
+        """Collapses the nodes matrix of a voxel array with a region aggregation matrix.
+
+        Parameters
+        ----------
+        nodes : np.array
+            The (rank x n_target_voxels) nodes matrix.
+        aggregation : sparse.spmatrix
+            The (n_structures x n_target_voxels) region aggregation matrix.
+        structure_names : List[str]
+            The names of the structures, one per row of the aggregation matrix.
+        structure_ids : List[int]
+            The ids of the structures, one per row of the aggregation matrix.
+        volumes : np.array
+            The number of voxels in each structure.
+        block_size : int
+            The number of rows of nodes read at a time, so a memory mapped nodes matrix is never copied whole.
+
+        Returns
+        -------
+        The RegionModel.
+        """
+        # vol_to_probs zeros a target voxel whose projection is NaN, so leave out any voxel with a NaN node
+        nan_voxels = np.zeros(nodes.shape[1], dtype=bool)
+        for start in range(0, nodes.shape[0], block_size):
+            nan_voxels |= np.isnan(nodes[start:start + block_size]).any(axis=0)
+        aggregation = sparse.csr_matrix(aggregation.multiply(~nan_voxels))
+        aggregation.eliminate_zeros()
+        reduced_nodes = np.empty((nodes.shape[0], aggregation.shape[0]))
+        for start in range(0, nodes.shape[0], block_size):
+            block = np.asarray(nodes[start:start + block_size])
+            reduced_nodes[start:start + block_size] = (aggregation @ block.T).T
+        return cls(structure_names, structure_ids, reduced_nodes, volumes)
+
+    @classmethod
+    def load(cls, fname: str) -> 'RegionModel':
+        """Loads a RegionModel written by save."""
+        with np.load(fname) as data:
+            return cls(data['structure_names'].tolist(), data['structure_ids'], data['reduced_nodes'],
+                       data['volumes'])
+
+    def save(self, fname: str) -> None:
+        """Saves the RegionModel to a .npz file."""
+        np.savez(fname,
+                 structure_names=np.array(self.structure_names),
+                 structure_ids=self.structure_ids,
+                 reduced_nodes=self.reduced_nodes,
+                 volumes=self.volumes)
+
+    def profile(self, weight_sum: np.array) -> np.array:
+        """Computes the summed projection strength to every structure.
+
+        Parameters
+        ----------
+        weight_sum : np.array
+            The (weighted) sum of the weight rows of the source voxels, or a stack of such sums along the
+            first axis.
+
+        Returns
+        -------
+        The projection strength to each structure, in the order of structure_names.
+        """
+        strengths = weight_sum @ self.reduced_nodes
+        np.nan_to_num(strengths, copy=False, nan=0.0)
+        return strengths
+
+    def columns(self, structure_name: List[str]) -> np.array:
+        """Finds the columns of the given structure names, or returns None if any of them are missing."""
+        positions = {name: i for i, name in enumerate(self.structure_names)}
+        if not all(name in positions for name in structure_name):
+            return None
+        return np.array([positions[name] for name in structure_name], dtype=int)
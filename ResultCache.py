@@ -0,0 +1,116 @@
+import hashlib
+import numpy as np
+import os
+import tempfile
+import zipfile
+from typing import Union
+
+RESULT_SUFFIX = '.npz'
+
+
+class ResultCache:
+    """An on-disk cache of projections in target mask space, keyed by a hash of what they were computed from (see
+    ProjPredictor.vol_to_probs), so that projecting the same source voxels again is a file read.
+
+    Each result is a compressed .npz file named after its key. Files are written to a temporary name and renamed
+    into place, so several processes (e.g. the notebook and batch workers) can share a directory. Once the files
+    take up more than max_bytes, the least recently used ones are deleted. A result that alone takes up more than
+    max_bytes is not stored, as it would be deleted straight away.
+
+    Attributes
+    ----------
+    directory : str
+        The directory the results are stored in
+    max_bytes : int
+        The most disk space the results may take up
+    hits : int
+        The number of lookups that found a result
+    misses : int
+        The number of lookups that didn't
+    """
+    def __init__(self, directory: str, max_bytes: int = 2 * 1024 ** 3) -> None:
+        """
+
+        Parameters
+        ----------
+        directory : str
+            The directory to store the results in. It is created if it does not exist.
+        max_bytes : int
+            The most disk space the results may take up.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts: Union[np.array, str, bytes, None]) -> str:
+        """Hashes arrays (their dtype, shape and contents) and strings into a key."""
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                part = np.ascontiguousarray(part)
+                digest.update(f'{part.dtype.str}{part.shape}'.encode())
+                digest.update(part.data)
+            elif isinstance(part, bytes):
+                digest.update(part)
+            else:
+                digest.update(repr(part).encode())
+            # Separate the parts so that different splits of the same bytes hash differently
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Union[np.array, None]:
+        """Returns the result stored under the key, or None if there isn't one."""
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                result = data['result']
+            os.utime(path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            # Missing, or deleted or half written by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result: np.array) -> None:
+        """Stores a result under the key, then evicts the least recently used results if over max_bytes. Results
+        that would take up more than max_bytes on their own are not stored."""
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez_compressed(f, result=result)
+            if os.path.getsize(temporary) > self.max_bytes:
+                os.remove(temporary)
+                return
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        """Deletes the least recently used results until they take up at most max_bytes."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(RESULT_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + RESULT_SUFFIX)
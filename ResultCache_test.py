@@ -0,0 +1,111 @@
+import numpy as np
+import os
+import pytest
+from ProjPredictor import ProjPredictor
+from ResultCache import ResultCache
+from SyntheticCache import SyntheticVoxelModelCache
+import VoxelSnapshot
+
+
+@pytest.fixture(scope='module')
+def synthetic_cache() -> SyntheticVoxelModelCache:
+    return SyntheticVoxelModelCache(seed=0)
+
+
+def test_hit_returns_the_stored_row(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    row = np.random.default_rng(0).random(1000)
+    key = ResultCache.key(np.arange(10), np.ones(10), 'model')
+    assert cache.get(key) is None
+    cache.put(key, row)
+    np.testing.assert_array_equal(cache.get(key), row)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_keys_differ_by_selection_values_and_dtype():
+    selected, values = np.arange(10), np.ones(10)
+    key = ResultCache.key(selected, values, 'model')
+    assert ResultCache.key(selected, values, 'model') == key
+    assert ResultCache.key(selected + 1, values, 'model') != key
+    assert ResultCache.key(selected, values * 2, 'model') != key
+    assert ResultCache.key(selected, values.astype(np.float32), 'model') != key
+    assert ResultCache.key(selected, values, 'other model') != key
+    # The parts are separated, so moving bytes from one part to the next changes the key
+    assert ResultCache.key(b'ab', b'c') != ResultCache.key(b'a', b'bc')
+
+
+def test_evicts_least_recently_used_down_to_max_bytes(tmp_path):
+    rng = np.random.default_rng(0)
+    rows = [rng.random(1000) for _ in range(4)]
+    cache = ResultCache(str(tmp_path), max_bytes=10 ** 9)
+    for i, row in enumerate(rows):
+        cache.put(str(i), row)
+        # Oldest first, as if each was written (or last read) a minute after the one before
+        os.utime(cache._path(str(i)), (i * 60, i * 60))
+    size = os.path.getsize(cache._path('0'))
+    cache.max_bytes = int(2.5 * size)
+    cache.evict()
+    assert sorted(os.listdir(tmp_path)) == ['2.npz', '3.npz']
+    assert cache.get('0') is None
+    np.testing.assert_array_equal(cache.get('3'), rows[3])
+
+
+def test_does_not_store_results_larger_than_max_bytes(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1000)
+    cache.put('small', np.zeros(10))
+    cache.put('large', np.random.default_rng(0).random(1000))
+    assert cache.get('large') is None
+    assert cache.get('small') is not None
+    # Neither the large result nor its temporary file is left behind
+    assert os.listdir(tmp_path) == ['small.npz']
+
+
+def test_skips_corrupt_and_half_written_files(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    with open(cache._path('corrupt'), 'wb') as f:
+        f.write(b'not an npz file')
+    cache.put('whole', np.arange(100.0))
+    with open(cache._path('whole'), 'rb') as f:
+        data = f.read()
+    with open(cache._path('half'), 'wb') as f:
+        f.write(data[:len(data) // 2])
+    assert cache.get('corrupt') is None
+    assert cache.get('half') is None
+    assert cache.misses == 2
+    np.testing.assert_array_equal(cache.get('whole'), np.arange(100.0))
+
+
+def test_vol_to_probs_reads_back_cached_projections(tmp_path, synthetic_cache):
+    pp = ProjPredictor(cache=synthetic_cache, result_cache=ResultCache(str(tmp_path)), incremental=False)
+    image = ProjPredictor.orient_image(np.random.default_rng(0).random((65, 88, 88)))
+    pp.set_oriented_image(image)
+    pp.select_source(0.98, 'Cerebellar nuclei')
+    projections = pp.vol_to_probs()
+    pp.set_oriented_image(image)
+    pp.select_source(0.98, 'Cerebellar nuclei')
+    np.testing.assert_array_equal(pp.vol_to_probs(), projections)
+    assert (pp.result_cache.hits, pp.result_cache.misses) == (1, 1)
+
+
+def test_model_version_hashes_the_whole_voxel_array(synthetic_cache, monkeypatch):
+    pp = ProjPredictor(cache=synthetic_cache)
+    weights, nodes = pp._voxel_array.weights, pp._voxel_array.nodes
+    assert pp.model_version == ProjPredictor(cache=synthetic_cache).model_version
+    assert pp.model_version != ProjPredictor(cache=synthetic_cache, dtype='float32').model_version
+    digest = VoxelSnapshot.model_digest(weights, nodes)
+    # A change to a single value anywhere in the weights or nodes changes the digest
+    changed = nodes.copy()
+    changed[-1, -1] += 1e-12
+    assert VoxelSnapshot.model_digest(weights, changed) != digest
+    # Hashing a chunk of rows at a time gives the same digest as hashing them all at once
+    monkeypatch.setattr(VoxelSnapshot, 'DIGEST_CHUNK_BYTES', 1000)
+    assert VoxelSnapshot.model_digest(weights, nodes) == digest
+
+
+def test_snapshot_stores_its_digest(tmp_path, synthetic_cache):
+    pp = ProjPredictor(cache=synthetic_cache)
+    pp.save_snapshot(str(tmp_path))
+    assert VoxelSnapshot.load_digest(str(tmp_path)) == VoxelSnapshot.model_digest(pp._voxel_array.weights,
+                                                                                  pp._voxel_array.nodes)
+    os.remove(os.path.join(tmp_path, VoxelSnapshot.DIGEST_FILE))
+    assert VoxelSnapshot.load_digest(str(tmp_path)) is None
@@ -0,0 +1,66 @@
+from typing import Union, List, FrozenSet
+
+
+class StructureIndex:
+    """An index over the structures of an allensdk StructureTree, built once, so that looking a structure up by
+    name, acronym or id is a dictionary lookup rather than a scan of the tree.
+
+    Attributes
+    ----------
+    by_id : dict
+        The structure record (as in StructureTree.nodes()) of every structure id
+    by_name : dict
+        The structure record of every full structure name
+    by_acronym : dict
+        The structure record of every structure acronym
+    """
+    def __init__(self, structure_tree) -> None:
+        """
+
+        Parameters
+        ----------
+        structure_tree : StructureTree
+            The structure tree to index, e.g. from VoxelModelCache.get_structure_tree().
+        """
+        structures = structure_tree.nodes()
+        self.by_id = {structure['id']: structure for structure in structures}
+        self.by_name = {structure['name']: structure for structure in structures}
+        self.by_acronym = {structure['acronym']: structure for structure in structures}
+        descendants = {structure['id']: {structure['id']} for structure in structures}
+        for structure in structures:
+            for ancestor_id in structure['structure_id_path']:
+                if ancestor_id in descendants:
+                    descendants[ancestor_id].add(structure['id'])
+        self._descendants = {structure_id: frozenset(ids) for structure_id, ids in descendants.items()}
+
+    def get(self, structure: Union[str, int]) -> dict:
+        """Returns the record of a structure given by full name, acronym or id, or None if there is no such
+        structure. Full names are tried before acronyms."""
+        if isinstance(structure, str):
+            return self.by_name.get(structure, self.by_acronym.get(structure))
+        return self.by_id.get(structure)
+
+    def __contains__(self, structure: Union[str, int]) -> bool:
+        return self.get(structure) is not None
+
+    def ids(self, structures: Union[str, int, List[Union[str, int]]]) -> List[int]:
+        """Returns the ids of structures given by full name, acronym or id, in the order they were given.
+
+        Raises
+        ------
+        KeyError
+            If a structure can't be found.
+        """
+        if not isinstance(structures, list):
+            structures = [structures]
+        ids = []
+        for structure in structures:
+            record = self.get(structure)
+            if record is None:
+                raise KeyError(f'Structure {structure!r} cannot be found in the structure tree.')
+            ids.append(record['id'])
+        return ids
+
+    def descendant_ids(self, structure_id: int) -> FrozenSet[int]:
+        """Returns the ids of a structure and of all of its descendants."""
+        return self._descendants[structure_id]
@@ -0,0 +1,194 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from typing import List, Tuple
+from VoxelSnapshot import IndexMask
+
+# A small part of the Allen structure hierarchy, as (id, name, acronym, parent id), covering the areas used in the
+# batch scripts and the notebook
+DEFAULT_STRUCTURES = [(997, 'root', 'root', None),
+                      (8, 'Basic cell groups and regions', 'grey', 997),
+                      (315, 'Isocortex', 'Isocortex', 8),
+                      (500, 'Somatomotor areas', 'MO', 315),
+                      (453, 'Somatosensory areas', 'SS', 315),
+                      (1057, 'Gustatory areas', 'GU', 315),
+                      (677, 'Visceral area', 'VISC', 315),
+                      (247, 'Auditory areas', 'AUD', 315),
+                      (669, 'Visual areas', 'VIS', 315),
+                      (31, 'Anterior cingulate area', 'ACA', 315),
+                      (714, 'Orbital area', 'ORB', 315),
+                      (1129, 'Interbrain', 'IB', 8),
+                      (549, 'Thalamus', 'TH', 1129),
+                      (685, 'Ventral medial nucleus of the thalamus', 'VM', 549),
+                      (512, 'Cerebellum', 'CB', 8),
+                      (519, 'Cerebellar nuclei', 'CBN', 512),
+                      (989, 'Fastigial nucleus', 'FN', 519),
+                      (91, 'Interposed nucleus', 'IP', 519),
+                      (846, 'Dentate nucleus', 'DN', 519)]
+
+
+class SyntheticVoxelArray:
+    """A factorized voxel connectivity array with the parts of the mcmodels VoxelConnectivityArray interface that
+    ProjPredictor uses: the weights and nodes matrices, and indexing rows to get their dense projections.
+
+    Attributes
+    ----------
+    weights : np.array
+        The (n_source_voxels x rank) weights matrix
+    nodes : np.array
+        The (rank x n_target_voxels) nodes matrix
+    """
+    def __init__(self, weights: np.array, nodes: np.array) -> None:
+        self.weights = weights
+        self.nodes = nodes
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.weights.shape[0], self.nodes.shape[1]
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.weights.dtype
+
+    def __getitem__(self, rows) -> np.array:
+        return self.weights[rows] @ self.nodes
+
+
+class SyntheticStructureTree:
+    """A structure tree with the parts of the allensdk StructureTree interface that ProjPredictor uses."""
+    def __init__(self, structures: List[Tuple[int, str, str, int]]) -> None:
+        parents = {structure_id: parent_id for structure_id, _, _, parent_id in structures}
+        self._nodes = []
+        for structure_id, name, acronym, _ in structures:
+            path = [structure_id]
+            while parents[path[0]] is not None:
+                path.insert(0, parents[path[0]])
+            self._nodes.append({'id': structure_id, 'name': name, 'acronym': acronym, 'structure_id_path': path})
+        self._by_id = {node['id']: node for node in self._nodes}
+
+    def nodes(self, node_ids: List[int] = None) -> List[dict]:
+        if node_ids is None:
+            return list(self._nodes)
+        return self.get_structures_by_id(node_ids)
+
+    def get_name_map(self) -> dict:
+        return {node['id']: node['name'] for node in self._nodes}
+
+    def get_structures_by_id(self, structure_ids: List[int]) -> List[dict]:
+        return [self._by_id[structure_id] for structure_id in structure_ids]
+
+    def get_structures_by_name(self, names: List[str]) -> List[dict]:
+        by_name = {node['name']: node for node in self._nodes}
+        return [by_name[name] for name in names]
+
+    def get_structures_by_acronym(self, acronyms: List[str]) -> List[dict]:
+        by_acronym = {node['acronym']: node for node in self._nodes}
+        return [by_acronym[acronym] for acronym in acronyms]
+
+    def descendant_ids(self, structure_ids: List[int]) -> List[List[int]]:
+        return [[node['id'] for node in self._nodes if structure_id in node['structure_id_path']]
+                for structure_id in structure_ids]
+
+
+class SyntheticReferenceSpace:
+    """A reference space with the parts of the allensdk ReferenceSpace interface that ProjPredictor uses."""
+    def __init__(self, annotation: np.array, structure_tree: SyntheticStructureTree) -> None:
+        self.annotation = annotation
+        self.structure_tree = structure_tree
+
+    def make_structure_mask(self, structure_ids: List[int]) -> np.array:
+        """Returns a uint8 mask of the voxels in any of the structures or their descendants."""
+        descendant_ids = [i for ids in self.structure_tree.descendant_ids(structure_ids) for i in ids]
+        return np.isin(self.annotation, descendant_ids).astype(np.uint8)
+
+
+class SyntheticVoxelModelCache:
+    """An offline stand-in for the mcmodels VoxelModelCache, for testing and benchmarking ProjPredictor without
+    downloaded data. Everything is generated deterministically from the seed.
+
+    The brain is an ellipsoid filling the annotation volume. Its voxels are split between the leaf structures of
+    the hierarchy as the Voronoi cells of a few random points per leaf, so every structure is spread over several
+    blobs. The source mask is the hemisphere with the
+    higher last coordinate and the target mask is the whole brain, as in the 100um voxel model. The weights and
+    nodes are non-negative random matrices of the given rank.
+
+    Attributes
+    ----------
+    annotation_shape : Tuple[int, int, int]
+        The shape of the annotation volume. Orienting images into it (ProjPredictor.orient_image) assumes
+        the 100um shape.
+    rank : int
+        The rank of the factorized voxel array
+    seed : int
+        The seed everything is generated from
+    """
+    def __init__(self,
+                 annotation_shape: Tuple[int, int, int] = (132, 80, 114),
+                 rank: int = 32,
+                 structures: List[Tuple[int, str, str, int]] = None,
+                 seed: int = 0,
+                 dtype: np.dtype = np.float64,
+                 blobs_per_structure: int = 8) -> None:
+        """
+
+        Parameters
+        ----------
+        annotation_shape : Tuple[int, int, int]
+            The shape of the annotation volume.
+        rank : int
+            The rank of the factorized voxel array.
+        structures : List[Tuple[int, str, str, int]]
+            The structure hierarchy as (id, name, acronym, parent id) tuples, with None as the root's parent.
+            Defaults to DEFAULT_STRUCTURES.
+        seed : int
+            The seed everything is generated from.
+        dtype : np.dtype
+            The dtype of the weights and nodes.
+        blobs_per_structure : int
+            The number of Voronoi cells each leaf structure is made of.
+        """
+        self.annotation_shape = tuple(annotation_shape)
+        self.rank = rank
+        self.seed = seed
+        self.dtype = dtype
+        self.blobs_per_structure = blobs_per_structure
+        self._structure_tree = SyntheticStructureTree(structures if structures is not None else DEFAULT_STRUCTURES)
+        self._reference_space = None
+        self._voxel_connectivity_array = None
+
+    def get_structure_tree(self) -> SyntheticStructureTree:
+        return self._structure_tree
+
+    def get_reference_space(self) -> SyntheticReferenceSpace:
+        if self._reference_space is None:
+            self._reference_space = SyntheticReferenceSpace(self._make_annotation(), self._structure_tree)
+        return self._reference_space
+
+    def get_voxel_connectivity_array(self) -> Tuple[SyntheticVoxelArray, IndexMask, IndexMask]:
+        if self._voxel_connectivity_array is None:
+            annotation = self.get_reference_space().annotation
+            brain = annotation.ravel() > 0
+            in_source_hemisphere = np.zeros(self.annotation_shape, dtype=bool)
+            in_source_hemisphere[:, :, self.annotation_shape[2] // 2:] = True
+            source_mask = IndexMask(np.flatnonzero(brain & in_source_hemisphere.ravel()), self.annotation_shape)
+            target_mask = IndexMask(np.flatnonzero(brain), self.annotation_shape)
+            rng = np.random.default_rng(self.seed + 1)
+            weights = rng.random((len(source_mask.indices), self.rank), dtype=np.float64).astype(self.dtype)
+            nodes = rng.random((self.rank, len(target_mask.indices)), dtype=np.float64).astype(self.dtype)
+            # Scale so that a single voxel's projections are on the order of probabilities
+            nodes /= self.rank * nodes.shape[1] / 1000
+            self._voxel_connectivity_array = (SyntheticVoxelArray(weights, nodes), source_mask, target_mask)
+        return self._voxel_connectivity_array
+
+    def _make_annotation(self) -> np.array:
+        rng = np.random.default_rng(self.seed)
+        shape = np.array(self.annotation_shape)
+        coordinates = np.indices(self.annotation_shape).reshape(3, -1).T
+        centre = (shape - 1) / 2
+        brain = np.flatnonzero((((coordinates - centre) / (shape / 2)) ** 2).sum(axis=1) <= 1)
+        nodes = self._structure_tree.nodes()
+        parents = {ancestor for node in nodes for ancestor in node['structure_id_path'][:-1]}
+        leaves = np.array([node['id'] for node in nodes if node['id'] not in parents])
+        seeds = coordinates[rng.choice(brain, size=len(leaves) * self.blobs_per_structure, replace=False)]
+        annotation = np.zeros(int(np.prod(shape)), dtype=np.uint32)
+        annotation[brain] = np.repeat(leaves, self.blobs_per_structure)[cKDTree(seeds).query(coordinates[brain])[1]]
+        return annotation.reshape(self.annotation_shape)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from SyntheticCache import SyntheticVoxelModelCache, DEFAULT_STRUCTURES
+from ProjPredictor import ProjPredictor
+
+SMALL_SHAPE = (20, 16, 18)
+STRUCTURES = [(1, 'root', 'root', None),
+              (2, 'Left', 'L', 1),
+              (3, 'Left front', 'LF', 2),
+              (4, 'Left back', 'LB', 2),
+              (5, 'Right', 'R', 1)]
+
+
+def arrays(cache: SyntheticVoxelModelCache):
+    voxel_array, source_mask, target_mask = cache.get_voxel_connectivity_array()
+    return (cache.get_reference_space().annotation, voxel_array.weights, voxel_array.nodes, source_mask.indices,
+            target_mask.indices)
+
+
+def test_deterministic_from_the_seed():
+    for first, second in zip(arrays(SyntheticVoxelModelCache(SMALL_SHAPE, seed=3)),
+                             arrays(SyntheticVoxelModelCache(SMALL_SHAPE, seed=3))):
+        np.testing.assert_array_equal(first, second)
+    annotation, weights = arrays(SyntheticVoxelModelCache(SMALL_SHAPE, seed=4))[:2]
+    assert not np.array_equal(annotation, arrays(SyntheticVoxelModelCache(SMALL_SHAPE, seed=3))[0])
+    assert not np.array_equal(weights, arrays(SyntheticVoxelModelCache(SMALL_SHAPE, seed=3))[1])
+
+
+def test_shape_rank_and_dtype_are_configurable():
+    cache = SyntheticVoxelModelCache(SMALL_SHAPE, rank=5, dtype=np.float32)
+    annotation, weights, nodes, source_indices, target_indices = arrays(cache)
+    assert annotation.shape == SMALL_SHAPE
+    assert weights.shape == (len(source_indices), 5) and nodes.shape == (5, len(target_indices))
+    assert weights.dtype == nodes.dtype == np.float32
+    # The source mask is the hemisphere with the higher last coordinate of the brain, the target the whole brain
+    np.testing.assert_array_equal(target_indices, np.flatnonzero(annotation))
+    assert np.all(np.unravel_index(source_indices, SMALL_SHAPE)[2] >= SMALL_SHAPE[2] // 2)
+    assert set(source_indices) <= set(target_indices)
+
+
+def test_structure_hierarchy():
+    cache = SyntheticVoxelModelCache(SMALL_SHAPE, structures=STRUCTURES, blobs_per_structure=2)
+    annotation = cache.get_reference_space().annotation
+    # Only the leaves are painted into the annotation
+    assert set(np.unique(annotation)) == {0, 3, 4, 5}
+    tree = cache.get_structure_tree()
+    assert tree.get_structures_by_acronym(['LB'])[0]['structure_id_path'] == [1, 2, 4]
+    assert sorted(tree.descendant_ids([2])[0]) == [2, 3, 4]
+    mask = cache.get_reference_space().make_structure_mask([2])
+    np.testing.assert_array_equal(mask, np.isin(annotation, [3, 4]).astype(np.uint8))
+
+
+def test_voxel_array_rows_are_dense_projections():
+    voxel_array = SyntheticVoxelModelCache(SMALL_SHAPE).get_voxel_connectivity_array()[0]
+    rows = np.array([0, 3, 7])
+    np.testing.assert_allclose(voxel_array[rows], voxel_array.weights[rows] @ voxel_array.nodes)
+    assert voxel_array.shape == (voxel_array.weights.shape[0], voxel_array.nodes.shape[1])
+
+
+@pytest.fixture(scope='module')
+def default_cache() -> SyntheticVoxelModelCache:
+    return SyntheticVoxelModelCache()
+
+
+@pytest.mark.parametrize('name', [name for _, name, _, _ in DEFAULT_STRUCTURES if name != 'root'])
+def test_default_structures_can_filter_by_name(default_cache, name):
+    pp = ProjPredictor(cache=default_cache)
+    assert pp.struct_ids_to_volume(pp.struct_names_to_ids(name)) > 0
@@ -0,0 +1,155 @@
+import hashlib
+import numpy as np
+import os
+from typing import Tuple, TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from mcmodels.models.voxel import VoxelConnectivityArray
+
+WEIGHTS_FILE = 'weights.npy'
+NODES_FILE = 'nodes.npy'
+SOURCE_INDICES_FILE = 'source_mask_indices.npy'
+TARGET_INDICES_FILE = 'target_mask_indices.npy'
+ANNOTATION_SHAPE_FILE = 'annotation_shape.npy'
+DIGEST_FILE = 'model_digest.txt'
+# The most bytes of the weights or nodes read at once while hashing them, so a memory mapped array isn't copied
+DIGEST_CHUNK_BYTES = 64 * 1024 ** 2
+
+
+class IndexMask:
+    """A lightweight stand-in for the mcmodels Mask that only keeps the flat annotation indices of the
+    masked voxels. It has the parts of the Mask interface that ProjPredictor uses.
+
+    Attributes
+    ----------
+    indices : np.array
+        The flat (C order) indices into the annotation volume of the voxels in the mask
+    annotation_shape : Tuple[int, int, int]
+        The shape of the annotation volume the mask lives in
+    """
+    def __init__(self, indices: np.array, annotation_shape: Tuple[int, int, int]) -> None:
+        self.indices = indices
+        self.annotation_shape = tuple(int(i) for i in annotation_shape)
+
+    @classmethod
+    def from_mask(cls, mask) -> 'IndexMask':
+        """Builds an IndexMask from an mcmodels Mask, keeping the same voxel order."""
+        indices = np.ravel_multi_index(tuple(mask.coordinates.T), mask.annotation_shape)
+        return cls(indices, mask.annotation_shape)
+
+    @property
+    def coordinates(self) -> np.array:
+        return np.column_stack(np.unravel_index(self.indices, self.annotation_shape))
+
+    @property
+    def masked_shape(self) -> Tuple[int]:
+        return (len(self.indices),)
+
+    def mask_volume(self, X: np.array) -> np.array:
+        """Returns the voxels of a volume (with optional trailing dimensions) that are in the mask."""
+        return X.reshape((-1,) + X.shape[3:])[self.indices]
+
+    def map_masked_to_annotation(self, y: np.array) -> np.array:
+        """Maps a vector in mask space back into a zero filled annotation volume, of the vector's dtype if it is
+        floating point and float64 otherwise."""
+        dtype = y.dtype if np.issubdtype(y.dtype, np.floating) else np.float64
+        volume = np.zeros(int(np.prod(self.annotation_shape)), dtype=dtype)
+        volume[self.indices] = y
+        return volume.reshape(self.annotation_shape)
+
+
+def save_snapshot(directory: str, voxel_array, source_mask, target_mask, dtype: np.dtype = None) -> None:
+    """Writes the weights, nodes and source/target mask indices of a voxel model to .npy files, along with the
+    model_digest of the weights and nodes.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to write to. It is created if it does not exist.
+    voxel_array : VoxelConnectivityArray
+        The factorized voxel connectivity array.
+    source_mask : Union[Mask, IndexMask]
+        The source mask that goes with the voxel array.
+    target_mask : Union[Mask, IndexMask]
+        The target mask that goes with the voxel array.
+    dtype : np.dtype
+        The floating point type to save the weights and nodes as, e.g. float32 to halve the snapshot. Defaults to
+        their current dtype.
+
+    Returns
+    -------
+    None
+    """
+    os.makedirs(directory, exist_ok=True)
+    if not isinstance(source_mask, IndexMask):
+        source_mask = IndexMask.from_mask(source_mask)
+    if not isinstance(target_mask, IndexMask):
+        target_mask = IndexMask.from_mask(target_mask)
+    np.save(os.path.join(directory, WEIGHTS_FILE), np.ascontiguousarray(voxel_array.weights, dtype=dtype))
+    np.save(os.path.join(directory, NODES_FILE), np.ascontiguousarray(voxel_array.nodes, dtype=dtype))
+    np.save(os.path.join(directory, SOURCE_INDICES_FILE), source_mask.indices)
+    np.save(os.path.join(directory, TARGET_INDICES_FILE), target_mask.indices)
+    np.save(os.path.join(directory, ANNOTATION_SHAPE_FILE), np.array(source_mask.annotation_shape))
+    # Hash the weights and nodes as they were saved, once, so loading the snapshot doesn't have to
+    weights = np.load(os.path.join(directory, WEIGHTS_FILE), mmap_mode='r')
+    nodes = np.load(os.path.join(directory, NODES_FILE), mmap_mode='r')
+    with open(os.path.join(directory, DIGEST_FILE), 'w') as f:
+        f.write(model_digest(weights, nodes))
+
+
+def load_snapshot(directory: str) -> Tuple['VoxelConnectivityArray', IndexMask, IndexMask]:
+    """Memory maps a snapshot written by save_snapshot.
+
+    The weights and nodes are opened read only with np.load(mmap_mode='r'), so loading is near instant and
+    the pages are shared between all processes that load the same snapshot.
+
+    Parameters
+    ----------
+    directory : str
+        The directory the snapshot was written to.
+
+    Returns
+    -------
+    The voxel array, source mask and target mask, in the same order as
+    VoxelModelCache.get_voxel_connectivity_array.
+    """
+    from mcmodels.models.voxel import VoxelConnectivityArray
+    weights = np.load(os.path.join(directory, WEIGHTS_FILE), mmap_mode='r')
+    nodes = np.load(os.path.join(directory, NODES_FILE), mmap_mode='r')
+    annotation_shape = np.load(os.path.join(directory, ANNOTATION_SHAPE_FILE))
+    source_mask = IndexMask(np.load(os.path.join(directory, SOURCE_INDICES_FILE)), annotation_shape)
+    target_mask = IndexMask(np.load(os.path.join(directory, TARGET_INDICES_FILE)), annotation_shape)
+    return VoxelConnectivityArray(weights, nodes), source_mask, target_mask
+
+
+def model_digest(weights: np.array, nodes: np.array) -> str:
+    """Hashes the dtype, shape and every value of the weights and nodes of a voxel array, reading them a chunk of
+    rows at a time.
+
+    Parameters
+    ----------
+    weights : np.array
+        The (n_source x rank) weights of the voxel array.
+    nodes : np.array
+        The (rank x n_target) nodes of the voxel array.
+
+    Returns
+    -------
+    The sha256 hex digest.
+    """
+    digest = hashlib.sha256()
+    for array in (weights, nodes):
+        digest.update(f'{array.dtype.str}{array.shape}'.encode())
+        rows = max(1, DIGEST_CHUNK_BYTES // max(1, array[:1].nbytes))
+        for start in range(0, array.shape[0], rows):
+            digest.update(np.ascontiguousarray(array[start:start + rows]).data)
+    return digest.hexdigest()
+
+
+def load_digest(directory: str) -> Union[str, None]:
+    """Reads the model_digest written by save_snapshot, or returns None for snapshots saved without one."""
+    try:
+        with open(os.path.join(directory, DIGEST_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
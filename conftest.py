@@ -0,0 +1,2 @@
+# ProjPredictor_test.py is a script run against the downloaded voxel model and the lab's images, not a test suite
+collect_ignore = ['ProjPredictor_test.py']